@@ -0,0 +1,128 @@
+"""Micro-benchmark: title normalization and match scoring, old loop-of-regexes vs compiled.
+
+    python bench/bench_titles.py [rounds]
+
+Runs both versions over a corpus of real Arabic/English YouTube and iTunes titles, checks that
+they produce identical output, and prints the time per call. The memoized numbers show the
+steady state inside the bot, where the same titles come back from cached searches.
+"""
+import os, re, sys, time, random
+from pathlib import Path
+
+os.environ.setdefault("TOKEN", "bench")   # main.py refuses to import without one
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+TITLES = [
+    "Amr Diab - Tamally Maak (Official Music Video) | عمرو دياب - تملي معاك",
+    "عمرو دياب - نور العين | Amr Diab - Nour El Ain [Official Audio]",
+    "Mohamed Hamaki - Ma Balash | محمد حماقي - ما بلاش (Official Lyrics Video)",
+    "Tamer Hosny - Ana Lak Ala Tool | تامر حسني - انا ليك على طول (Lyrics)",
+    "Elissa - Aa Bali Habibi (Official Clip) | إليسا - ع بالي حبيبي",
+    "Nancy Ajram - Ah W Noss | نانسي عجرم - آه ونص [HD]",
+    "Wegz - Dorak Gai | ويجز - دورك جاي (Official Music Video)",
+    "Marwan Pablo - Free | مروان بابلو - فري (Prod. by Molotof)",
+    "Sherine - Mashaer | شيرين - مشاعر (Official Audio) HQ",
+    "Fairuz - Kifak Inta | فيروز - كيفك انت (Live)",
+    "أم كلثوم - انت عمري - حفلة كاملة (Remastered) 4K",
+    "Abdel Halim Hafez - Gana El Hawa | عبد الحليم حافظ - جانا الهوى live remaster",
+    "Kadim Al Sahir - Zidini Ishqan | كاظم الساهر - زيديني عشقا [Arabic Lyrics]",
+    "Ragheb Alama - Tab Leh | راغب علامة - طب ليه - Official Video Clip",
+    "Mohamed Mounir - Ezzay | محمد منير - ازاي (Lyric Video)",
+    "Cairokee - Kan Lak Ma'aya | كايروكي - كان لك معايا",
+    "Balqees - Majbourah | بلقيس - مجبورة (Official Music Video) 2023",
+    "Haifa Wehbe - Ragab | هيفاء وهبي - رجب (sped up)",
+    "Mahmoud El Esseily - Kol Haga Bet3ady | محمود العسيلي — كل حاجة بتعدي",
+    "Hussain Al Jassmi - Boshret Kheir | حسين الجسمي – بشرة خير | Official Video",
+    "The Weeknd - Blinding Lights (Official Audio)",
+    "Ed Sheeran - Shape of You [Official Lyric Video]",
+    "Adele - Hello (Official Music Video)",
+    "Coldplay - Yellow (Official Video) 4K Remastered",
+    "Billie Eilish - bad guy (Slowed + Reverb)",
+    "Dua Lipa - Levitating feat. DaBaby (Official Music Video)",
+    "Queen – Bohemian Rhapsody (Official Video Remastered)",
+    "Imagine Dragons - Believer (Lyrics) | English Lyrics",
+    "Arctic Monkeys - Do I Wanna Know? (Official Video) HD",
+    "Taylor Swift - Anti-Hero (Official Music Video) {Color Coded}",
+    "BTS (방탄소년단) 'Dynamite' Official MV",
+    "Calum Scott - Dancing On My Own (Acoustic Cover) | karaoke version",
+    "Alan Walker - Faded (8D AUDIO) 🎧",
+    "Rema, Selena Gomez - Calm Down (Nightcore)",
+    "Eminem - Lose Yourself [HD] (Lyrics)",
+    "Kanye West - Runaway (Visualizer)",
+    "Fairuz - Li Beirut | فيروز - لبيروت (Arabic Sub)",
+    "Warda - Batwanes Beek | وردة - بتونس بيك - Live Performance",
+    "Nassif Zeytoun - Mesh Aam Tezbat Ma'ak | ناصيف زيتون - مش عم تظبط معك - official audio",
+    "Assala - Ya Magnoun | أصالة - يا مجنون (Lyrics Video) | 2021",
+]
+TRACKS = [{"trackName": t.split(" - ", 1)[-1], "artistName": t.split(" - ", 1)[0]} for t in TITLES]
+QUERIES = ["تملي معاك", "amr diab", "shape of you", "فيروز", "blinding lights the weeknd", "ma balash"]
+
+
+def legacy_norm_song_title(raw: str, words) -> str:
+    if not raw:
+        return ""
+    s = raw.lower()
+    s = re.sub(r"\([^)]*\)", " ", s)
+    s = re.sub(r"\[[^\]]*\]", " ", s)
+    s = re.sub(r"\{[^}]*\}", " ", s)
+    s = s.replace("—", "-").replace("–", "-").replace("|", " ")
+    for w in words:
+        s = re.sub(rf"\b{re.escape(w)}\b", " ", s)
+    s = re.sub(r"[^a-z0-9\u0621-\u064A\s\-]+", " ", s)
+    s = re.sub(r"\s+", " ", s).strip()
+    return s
+
+
+def legacy_score_match(query, t) -> float:
+    q = query.lower()
+    name = (t.get("trackName") or "").lower()
+    artist = (t.get("artistName") or "").lower()
+    score = 0.0
+    if q in name: score += 3
+    if q in (name + " " + artist): score += 3
+    q_tokens = set(q.split())
+    score += len(q_tokens & set(name.split())) * 1.5
+    score += len(q_tokens & set(artist.split())) * 1.0
+    return score
+
+
+def timeit(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+
+def main_(rounds: int):
+    # The old loop walked a set, so its order varied per process; longest-first is the order
+    # that never lets "audio" pre-empt "official audio", and it is what the compiled regex does.
+    ordered = sorted(main.BAD_WORDS, key=lambda w: (-len(w), w))
+    new_norm = main.norm_song_title.__wrapped__
+    for t in TITLES:
+        assert new_norm(t) == legacy_norm_song_title(t, ordered), t
+    for q in QUERIES:
+        for t in TRACKS:
+            assert main.score_match(q, t) == legacy_score_match(q, t), (q, t)
+    print(f"identical output on {len(TITLES)} titles and {len(QUERIES) * len(TRACKS)} score pairs")
+
+    words = list(main.BAD_WORDS)
+    random.shuffle(words)
+    rows = [
+        ("norm_song_title  legacy", lambda: [legacy_norm_song_title(t, words) for t in TITLES]),
+        ("norm_song_title  compiled", lambda: [new_norm(t) for t in TITLES]),
+        ("norm_song_title  memoized", lambda: [main.norm_song_title(t) for t in TITLES]),
+        ("best_n           legacy", lambda: [sorted(TRACKS, key=lambda t: legacy_score_match(q, t)) for q in QUERIES]),
+        ("best_n           memoized", lambda: [main.best_n(q, TRACKS, n=30) for q in QUERIES]),
+    ]
+    base = {}
+    for label, fn in rows:
+        fn()   # warm caches
+        secs = timeit(fn, rounds)
+        kind = label.split()[0]
+        base.setdefault(kind, secs)
+        print(f"{label:28s} {secs * 1e6:9.1f} µs/round  x{base[kind] / secs:5.1f}")
+
+
+if __name__ == "__main__":
+    main_(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,421 @@
+"""Offline load test: the real Application and handlers against local stand-ins.
+
+    python bench/loadtest.py [scenario ...] [--users 50] [--rounds 5] [--json out.json] [--compare base.json]
+
+Scenarios: search, apple, download, ai, convert, mixed (default: all of them).
+
+Nothing leaves the machine:
+  * Telegram   a fake Bot API server on 127.0.0.1 (main.MiniHTTPServer); the bot talks to it over
+               HTTP through TG_API_URL, so PTB's request path and our rate limiter are exercised.
+  * YouTube / iTunes / Gemini   an httpx.MockTransport installed as main's shared client,
+               with per-upstream delay and failure rate (Gemini streams SSE chunks).
+  * yt-dlp / FFmpeg   fake process-pool jobs that sleep for the "download", burn CPU for the
+               "transcode" and write a small file, with a configurable failure rate.
+
+Every update goes through app.update_processor, i.e. the same CONCURRENT_UPDATES limit as
+production. Latency is measured per update (enqueue -> all handlers done); the report has
+p50/p95/p99, updates/sec, handler errors, Bot API calls and peak RSS (bot process and pool
+workers). --json writes the numbers, --compare exits 1 when p95 or throughput regress by
+more than --tolerance against a previous --json file.
+"""
+import os, sys, json, time, random, socket, asyncio, argparse, tempfile, hashlib, resource, urllib.parse
+from email.parser import BytesParser
+from email.policy import HTTP
+from pathlib import Path
+
+SCENARIOS = ("search", "apple", "download", "ai", "convert", "mixed")
+BOT_TOKEN = "123456:bench"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    p.add_argument("--users", type=int, default=50, help="concurrent simulated users")
+    p.add_argument("--rounds", type=int, default=5, help="updates per user per scenario")
+    p.add_argument("--think", type=float, default=0.0, help="max random pause between a user's updates (s)")
+    p.add_argument("--queries", type=int, default=20, help="distinct queries/videos shared by users (overlap = cache hits)")
+    p.add_argument("--tg-delay", type=float, default=0.005, help="fake Bot API latency per call (s)")
+    p.add_argument("--tg-429", type=float, default=0.0, help="fraction of Bot API calls answered with 429")
+    p.add_argument("--api-delay", type=float, default=0.05, help="YouTube/iTunes stub latency (s)")
+    p.add_argument("--api-fail", type=float, default=0.0, help="YouTube/iTunes stub 5xx rate")
+    p.add_argument("--ai-chunks", type=int, default=8, help="SSE chunks per Gemini reply")
+    p.add_argument("--ai-chunk-delay", type=float, default=0.05, help="delay between Gemini chunks (s)")
+    p.add_argument("--dl-delay", type=float, default=0.5, help="fake yt-dlp download time (s)")
+    p.add_argument("--transcode-cpu", type=float, default=0.2, help="fake FFmpeg CPU time per job (s)")
+    p.add_argument("--dl-fail", type=float, default=0.0, help="fake yt-dlp failure rate")
+    p.add_argument("--audio-kb", type=int, default=256, help="size of the fake m4a files")
+    p.add_argument("--workers", type=int, default=0, help="MEDIA_WORKERS (default: main.py's)")
+    p.add_argument("--real-limits", action="store_true", help="keep Telegram's per-chat/global rate limits")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--compare", help="baseline --json file to check against")
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed p95/throughput regression (fraction)")
+    args = p.parse_args()
+    unknown = sorted(set(args.scenarios) - set(SCENARIOS))
+    if unknown:
+        p.error(f"unknown scenario(s): {', '.join(unknown)}")
+    return args
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure_env(args, tg_port: int, tmp: Path):
+    """main.py reads its settings at import time, so this has to run first."""
+    os.environ.update({
+        "TOKEN": BOT_TOKEN,
+        "TG_API_URL": f"http://127.0.0.1:{tg_port}",
+        "ADMIN_ID": "0",
+        "YT_API_KEYS": "bench-key-1,bench-key-2",
+        "YT_DAILY_QUOTA": "100000000",
+        "GEMINI_KEY": "bench",
+        "STATE_DB_PATH": str(tmp / "state.db"),
+        "METRICS_PORT": "0",
+        "AUDIO_FILE_CACHE_DIR": "",
+        "MEDIA_QUEUE_MAX": str(max(20, args.users * 2)),
+        "BENCH_DL_DELAY": str(args.dl_delay),
+        "BENCH_TRANSCODE_CPU": str(args.transcode_cpu),
+        "BENCH_DL_FAIL": str(args.dl_fail),
+        "BENCH_AUDIO_KB": str(min(args.audio_kb, 900)),   # MiniHTTPServer takes bodies up to 1 MB
+    })
+    if args.workers:
+        os.environ["MEDIA_WORKERS"] = str(args.workers)
+    if not args.real_limits:
+        os.environ.update({"TG_GLOBAL_RATE": "1000000", "TG_CHAT_RATE": "1000000",
+                           "TG_GROUP_RATE": "1000000", "TG_CHAT_BURST": "1000000"})
+
+
+# ========= Fake yt-dlp / FFmpeg (run in main's process pool) =========
+
+def _burn(seconds: float):
+    end = time.process_time() + seconds
+    x = 0
+    while time.process_time() < end:
+        x += 1
+    return x
+
+def fake_ytdlp_job(youtube_url, ydl_opts):
+    t0 = time.monotonic()
+    time.sleep(float(os.environ["BENCH_DL_DELAY"]))
+    if random.random() < float(os.environ["BENCH_DL_FAIL"]):
+        raise RuntimeError("ERROR: [youtube] bench: Video unavailable")
+    t1 = time.monotonic()
+    _burn(float(os.environ["BENCH_TRANSCODE_CPU"]))
+    vid = urllib.parse.parse_qs(urllib.parse.urlparse(youtube_url).query).get("v", ["x"])[0]
+    path = Path(ydl_opts["outtmpl"]).parent / f"{vid}.m4a"
+    size = int(os.environ["BENCH_AUDIO_KB"]) * 1024
+    path.write_bytes(os.urandom(size))
+    return {"path": str(path), "parts": [{"path": str(path), "title": f"Bench {vid}", "bytes": size}],
+            "title": f"Bench {vid}", "artist": "Bench Artist", "mode": "remux",
+            "timings": {"download": t1 - t0, "transcode": time.monotonic() - t1},
+            "bytes": {"download": size, "output": size}}
+
+def fake_ffmpeg_job(in_path, out_path, bitrate="192k"):
+    t0 = time.monotonic()
+    _burn(float(os.environ["BENCH_TRANSCODE_CPU"]))
+    if random.random() < float(os.environ["BENCH_DL_FAIL"]):
+        raise RuntimeError("ffmpeg failed: bench")
+    Path(out_path).write_bytes(Path(in_path).read_bytes())
+    return {"path": out_path, "copied": False, "timings": {"transcode": time.monotonic() - t0}}
+
+
+# ========= Fake Telegram Bot API =========
+
+class FakeTelegram:
+    """Answers the Bot API methods the bot uses with minimal valid objects."""
+
+    def __init__(self, delay: float, rate_429: float):
+        self.delay, self.rate_429 = delay, rate_429
+        self.calls: dict = {}
+        self.msg_ids = iter(range(10_000, 10 ** 9))
+        self.file_bytes = os.urandom(64 * 1024)
+        self.bot_user = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                         "can_join_groups": True, "can_read_all_group_messages": False,
+                         "supports_inline_queries": True}
+
+    @staticmethod
+    def _params(headers, body: bytes) -> dict:
+        ctype = headers.get("content-type", "")
+        if ctype.startswith("multipart/"):
+            msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+            out = {}
+            for part in msg.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                out[name] = part.get_payload(decode=True) if part.get_filename() else part.get_content()
+            return out
+        if ctype.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+
+    def _message(self, params: dict, **extra) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        return {"message_id": next(self.msg_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": self.bot_user, **extra}
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return self.bot_user
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendAudio":
+            fid = "aud-" + hashlib.sha1(str(params.get("caption", "")).encode()).hexdigest()[:16]
+            return self._message(params, audio={"file_id": fid, "file_unique_id": fid[-8:], "duration": 180})
+        if method == "sendDocument":
+            return self._message(params, document={"file_id": "doc-bench", "file_unique_id": "docbench"})
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": f"u{random.getrandbits(32)}",
+                    "file_size": len(self.file_bytes), "file_path": "docs/bench.bin"}
+        return True   # answerCallbackQuery, sendChatAction, answerInlineQuery, ...
+
+    def routes(self) -> dict:
+        def api(method):
+            async def route(_, headers, body):
+                self.calls[method] = self.calls.get(method, 0) + 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                if self.rate_429 and method != "getMe" and random.random() < self.rate_429:
+                    return 429, "application/json", json.dumps({
+                        "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1}}).encode()
+                result = self._result(method, self._params(headers, body))
+                return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+            return route
+
+        async def file_download(method, headers, body):
+            return 200, "application/octet-stream", self.file_bytes
+
+        methods = ("getMe", "sendMessage", "editMessageText", "sendAudio", "sendDocument", "getFile",
+                   "sendChatAction", "answerCallbackQuery", "answerInlineQuery", "deleteWebhook", "getUpdates")
+        routes = {f"/bot{BOT_TOKEN}/{m}": api(m) for m in methods}
+        for token in (BOT_TOKEN, urllib.parse.quote(BOT_TOKEN)):   # PTB percent-encodes the token in file URLs
+            routes[f"/file/bot{token}/docs/bench.bin"] = file_download
+        return routes
+
+
+# ========= Upstream stubs (YouTube Data API, iTunes, Gemini) =========
+
+def upstream_transport(httpx, args):
+    def vid_for(text: str, i: int) -> str:
+        return hashlib.sha1(f"{text}|{i}".encode()).hexdigest()[:11]
+
+    async def handler(request):
+        host, path = request.url.host, request.url.path
+        q = dict(request.url.params)
+        if host != "generativelanguage.googleapis.com":
+            await asyncio.sleep(args.api_delay)
+            if random.random() < args.api_fail:
+                return httpx.Response(503, json={"error": "bench"})
+        if host == "www.googleapis.com" and path == "/youtube/v3/search":
+            n = int(q.get("maxResults", 12))
+            items = [{"id": {"videoId": vid_for(q["q"], i)},
+                      "snippet": {"title": f"{q['q']} - Song {i} (Official Video)", "channelTitle": f"Artist {i}"}}
+                     for i in range(n)]
+            return httpx.Response(200, json={"items": items})
+        if host == "itunes.apple.com" and path == "/search":
+            term, n = q.get("term", ""), int(q.get("limit", 8))
+            results = [{"trackId": int(hashlib.sha1(f"{term}|{i}".encode()).hexdigest()[:8], 16),
+                        "trackName": f"{term} {i}", "artistName": f"Artist {i}",
+                        "collectionName": "Bench Album", "previewUrl": f"https://audio.example/{i}.m4a",
+                        "trackViewUrl": "https://music.apple.com/bench", "trackTimeMillis": 200_000}
+                       for i in range(n)]
+            return httpx.Response(200, json={"resultCount": len(results), "results": results})
+        if host == "itunes.apple.com" and path == "/lookup":
+            tid = int(q.get("id", 0))
+            return httpx.Response(200, json={"resultCount": 1, "results": [
+                {"trackId": tid, "trackName": f"Track {tid}", "artistName": "Artist",
+                 "previewUrl": "https://audio.example/p.m4a"}]})
+        if host == "generativelanguage.googleapis.com":
+            async def sse():
+                for i in range(args.ai_chunks):
+                    await asyncio.sleep(args.ai_chunk_delay)
+                    chunk = {"candidates": [{"content": {"parts": [{"text": f"جزء {i} من الرد. "}]}}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode()
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=sse())
+        return httpx.Response(404, json={"error": f"no stub for {host}{path}"})
+
+    return httpx.MockTransport(handler)
+
+
+# ========= Update factories =========
+
+class Updates:
+    def __init__(self):
+        self.ids = iter(range(1, 10 ** 9))
+
+    @staticmethod
+    def user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}", "language_code": "ar"}
+
+    def _message(self, uid: int, **extra) -> dict:
+        return {"message_id": next(self.ids), "date": int(time.time()), "from": self.user(uid),
+                "chat": {"id": uid, "type": "private", "first_name": f"User{uid}"}, **extra}
+
+    def text(self, uid: int, text: str) -> dict:
+        return {"update_id": next(self.ids), "message": self._message(uid, text=text)}
+
+    def document(self, uid: int) -> dict:
+        doc = {"file_id": f"doc{uid}-{next(self.ids)}", "file_unique_id": f"du{uid}", "file_name": "clip.mp4",
+               "mime_type": "video/mp4", "file_size": 65536}
+        return {"update_id": next(self.ids), "message": self._message(uid, document=doc)}
+
+    def callback(self, uid: int, data: str) -> dict:
+        bot_msg = {"message_id": next(self.ids), "date": int(time.time()), "text": "results",
+                   "chat": {"id": uid, "type": "private"},
+                   "from": {"id": 123456, "is_bot": True, "first_name": "Bench"}}
+        return {"update_id": next(self.ids), "callback_query": {
+            "id": str(next(self.ids)), "from": self.user(uid), "chat_instance": str(uid), "data": data,
+            "message": bot_msg}}
+
+
+# ========= Runner =========
+
+def pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def peak_rss_mb():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024, child_kb / 1024
+
+def handler_errors(main) -> float:
+    return sum(main.METRICS.counters.get("bot_handler_errors_total", {}).values())
+
+
+async def run_scenario(name, args, main, app, fake, factory):
+    from telegram import Update
+    rng = random.Random(f"{args.seed}|{name}")
+    queries = [f"{name} query {i}" for i in range(args.queries)]
+    videos = [hashlib.sha1(f"{name}|{i}".encode()).hexdigest()[:11] for i in range(args.queries)]
+    base_uid = 1_000_000 * (SCENARIOS.index(name) + 1)
+    latencies, kinds = [], {}
+
+    def prepare(uid: int, kind: str):
+        main.user_mode[uid] = "ai" if kind == "ai" else "music"
+        main.set_pref(uid, "source", "apple" if kind == "apple" else "youtube")
+
+    def make(uid: int, kind: str) -> dict:
+        if kind in ("search", "apple"):
+            return factory.text(uid, rng.choice(queries))
+        if kind == "download":
+            return factory.callback(uid, f"yt|{rng.choice(videos)}")
+        if kind == "ai":
+            return factory.text(uid, f"سؤال رقم {rng.randrange(1000)} عن الموسيقى؟")
+        return factory.document(uid)
+
+    async def one_user(uid: int):
+        for _ in range(args.rounds):
+            kind = rng.choice(("search", "search", "download", "ai", "apple")) if name == "mixed" else name
+            prepare(uid, kind)
+            update = Update.de_json(make(uid, kind), app.bot)
+            t0 = time.perf_counter()
+            await app.update_processor.process_update(update, app.process_update(update))
+            dt = time.perf_counter() - t0
+            latencies.append(dt)
+            kinds.setdefault(kind, []).append(dt)
+            if args.think:
+                await asyncio.sleep(rng.uniform(0, args.think))
+
+    calls_before, errors_before = sum(fake.calls.values()), handler_errors(main)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one_user(base_uid + i) for i in range(args.users)))
+    wall = time.perf_counter() - t0
+    rss_self, rss_children = peak_rss_mb()
+    result = {
+        "updates": len(latencies), "seconds": wall, "updates_per_s": len(latencies) / wall if wall else 0.0,
+        "p50_ms": pct(latencies, 0.50) * 1000, "p95_ms": pct(latencies, 0.95) * 1000,
+        "p99_ms": pct(latencies, 0.99) * 1000, "max_ms": max(latencies, default=0) * 1000,
+        "handler_errors": handler_errors(main) - errors_before,
+        "bot_api_calls": sum(fake.calls.values()) - calls_before,
+        "peak_rss_mb": rss_self, "peak_worker_rss_mb": rss_children,
+    }
+    if len(kinds) > 1:
+        result["by_kind"] = {k: {"n": len(v), "p50_ms": pct(v, 0.5) * 1000, "p95_ms": pct(v, 0.95) * 1000}
+                             for k, v in sorted(kinds.items())}
+    return result
+
+
+def report(results: dict):
+    print(f"\n{'scenario':<10}{'updates':>8}{'upd/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}{'errors':>8}{'API calls':>10}{'RSS MB':>8}{'workers':>9}")
+    for name, r in results.items():
+        print(f"{name:<10}{r['updates']:>8}{r['updates_per_s']:>9.1f}{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}"
+              f"{r['p99_ms']:>9.0f}{r['max_ms']:>9.0f}{r['handler_errors']:>8.0f}{r['bot_api_calls']:>10}"
+              f"{r['peak_rss_mb']:>8.0f}{r['peak_worker_rss_mb']:>9.0f}")
+        for kind, k in r.get("by_kind", {}).items():
+            print(f"  {kind:<8}{k['n']:>8}{'':>9}{k['p50_ms']:>9.0f}{k['p95_ms']:>9.0f}")
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> bool:
+    base = json.loads(Path(baseline_path).read_text())["results"]
+    ok = True
+    print(f"\nvs {baseline_path} (tolerance {tolerance:.0%}):")
+    for name, r in results.items():
+        b = base.get(name)
+        if not b:
+            continue
+        p95 = r["p95_ms"] / b["p95_ms"] - 1 if b["p95_ms"] else 0.0
+        ups = r["updates_per_s"] / b["updates_per_s"] - 1 if b["updates_per_s"] else 0.0
+        bad = p95 > tolerance or ups < -tolerance
+        ok &= not bad
+        print(f"  {name:<10} p95 {p95:+.0%}  upd/s {ups:+.0%}" + ("  REGRESSION" if bad else ""))
+    return ok
+
+
+async def amain(args) -> int:
+    import httpx, main
+
+    main.ytdlp_job = fake_ytdlp_job
+    main.ffmpeg_m4a_job = fake_ffmpeg_job
+    main.TO_M4A_MODE = "stream"
+    main._http = httpx.AsyncClient(transport=upstream_transport(httpx, args), timeout=main.HTTP_TIMEOUT)
+
+    fake = FakeTelegram(args.tg_delay, args.tg_429)
+    server = main.MiniHTTPServer(fake.routes())
+    await server.start("127.0.0.1", int(main.TG_API_URL.rsplit(":", 1)[1]))
+    main.load_users()
+    main.load_audio_cache()
+    app = main.build_app()
+    await app.initialize()
+    await main.on_startup(app)
+    results = {}
+    try:
+        for name in args.scenarios or SCENARIOS:
+            print(f"▶ {name}: {args.users} users × {args.rounds} updates ...", flush=True)
+            results[name] = await run_scenario(name, args, main, app, fake, Updates())
+    finally:
+        await main.on_shutdown(app)
+        await app.shutdown()
+        await server.stop()
+
+    report(results)
+    print("\n" + main.MEDIA.stats_line())
+    print(main.FLIGHTS.stats_line())
+    print(main.TG_LIMITER.stats_line())
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": vars(args), "results": results}, indent=2, ensure_ascii=False))
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    tmp = Path(tempfile.mkdtemp(prefix="bot_bench_"))
+    configure_env(args, free_port(), tmp)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    try:
+        code = asyncio.run(amain(args))
+    finally:
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+    sys.exit(code)
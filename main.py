@@ -1,11 +1,66 @@
-import os, json, logging, urllib.parse, re, unicodedata, requests
-import yt_dlp
-import tempfile
+import time
+STARTUP_T0 = time.perf_counter()   # baseline for the startup report
+import os, sys, json, logging, urllib.parse, re, unicodedata, random, bisect, importlib, math
+import sqlite3, threading, heapq, itertools, hmac, signal, secrets
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import tempfile, shutil, subprocess
 import asyncio
 
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Any, List, Optional, Set, Tuple, Callable, Awaitable, AsyncIterator, Iterable
 from pathlib import Path
-from dotenv import load_dotenv
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# ========= Startup timing & lazy imports =========
+IMPORT_TIMES: Dict[str, float] = {}    # module -> seconds spent importing it
+STARTUP_MARKS: Dict[str, float] = {}   # milestone -> seconds since STARTUP_T0
+
+@contextmanager
+def import_timer(name: str):
+    t0 = time.perf_counter()
+    yield
+    IMPORT_TIMES.setdefault(name, time.perf_counter() - t0)
+
+def startup_mark(milestone: str):
+    STARTUP_MARKS.setdefault(milestone, time.perf_counter() - STARTUP_T0)
+
+def startup_report() -> str:
+    imports = ", ".join(f"{m} {t * 1000:.0f}ms" for m, t in sorted(IMPORT_TIMES.items(), key=lambda kv: -kv[1]))
+    marks = ", ".join(f"{m} {t:.2f}s" for m, t in sorted(STARTUP_MARKS.items(), key=lambda kv: kv[1]))
+    return f"startup: imports {imports or '—'}; {marks or '—'}"
+
+class LazyModule:
+    """Stands in for a heavy module: imported on first attribute access, or ahead of time by the
+    post-start warm-up, so the bot starts taking updates without paying for it."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            with import_timer(self._name):
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+yt_dlp = LazyModule("yt_dlp")   # downloads and yt-dlp search only
+pydub = LazyModule("pydub")     # TO_M4A_MODE=pydub only
+
+with import_timer("httpx"):
+    import httpx
+with import_timer("dotenv"):
+    from dotenv import load_dotenv
 
 # ========= ENV =========
 ENV_PATH = Path(__file__).with_name(".env")
@@ -13,60 +68,849 @@ load_dotenv(ENV_PATH)
 
 TOKEN      = os.getenv("TOKEN")
 YT_API_KEY = os.getenv("YT_API_KEY", "")
+YT_API_KEYS = [k.strip() for k in os.getenv("YT_API_KEYS", YT_API_KEY).split(",") if k.strip()]
 ADMIN_ID   = int(os.getenv("ADMIN_ID", "0"))
 GEMINI_KEY = os.getenv("GEMINI_KEY", "")
+TG_API_URL = os.getenv("TG_API_URL", "").rstrip("/")   # self-hosted Bot API server; empty = api.telegram.org
 
 if not TOKEN:
     raise SystemExit("TOKEN missing in .env")
 
 # ========= Telegram imports =========
+with import_timer("telegram"):
+    import telegram, telegram.ext
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, InputFile
+    Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, InputFile,
+    InlineQueryResultArticle, InlineQueryResultAudio, InlineQueryResultCachedAudio, InputTextMessageContent
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters
+    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler,
+    ContextTypes, filters, BaseRateLimiter, TypeHandler
 )
 
 # ========= Logging =========
 logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 log = logging.getLogger("musicbot")
+logging.getLogger("httpx").setLevel(logging.WARNING)   # per-request lines would leak API keys in query strings
+
+# ========= Metrics (latency histograms + counters, Prometheus text) =========
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, str, Dict[str, str], float]   # (name, "gauge"|"counter", labels, value)
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.count, self.sum = 0, 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Linear interpolation inside the bucket holding the q-th observation (like histogram_quantile)."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lo = self.buckets[i - 1] if i else 0.0
+                return lo + (self.buckets[i] - lo) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+class Metrics:
+    """In-process registry. Hot paths only bump numbers; gauges (queue depths, cache sizes, ...)
+    come from collectors that run at scrape time."""
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.help: Dict[str, str] = {}
+        self.buckets: Dict[str, Tuple[float, ...]] = {}
+        self.collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def describe(self, name: str, help_text: str, buckets: Optional[Tuple[float, ...]] = None):
+        self.help[name] = help_text
+        if buckets:
+            self.buckets[name] = buckets
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        h = series.get(key)
+        if h is None:
+            h = series[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+        h.observe(seconds)
+
+    def inc(self, name: str, n: float = 1, **labels: str):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + n
+
+    @contextmanager
+    def timer(self, name: str, **labels: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    @staticmethod
+    def _fmt_labels(labels: Iterable[Tuple[str, Any]]) -> str:
+        parts = []
+        for k, v in labels:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{v}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        out: List[str] = []
+
+        def header(name: str, kind: str):
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} {kind}")
+
+        for name, series in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for labels, h in sorted(series.items()):
+                cum = 0
+                for le, c in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cum += c
+                    out.append(f"{name}_bucket{self._fmt_labels(labels + (('le', le),))} {cum}")
+                out.append(f"{name}_sum{self._fmt_labels(labels)} {h.sum:.6f}")
+                out.append(f"{name}_count{self._fmt_labels(labels)} {h.count}")
+        for name, series in sorted(self.counters.items()):
+            header(name, "counter")
+            for labels, v in sorted(series.items()):
+                out.append(f"{name}{self._fmt_labels(labels)} {v:g}")
+        collected: Dict[str, Tuple[str, List[Tuple[Dict[str, str], float]]]] = {}
+        for collector in self.collectors:
+            try:
+                for name, kind, labels, value in collector():
+                    collected.setdefault(name, (kind, []))[1].append((labels, value))
+            except Exception:
+                log.exception("Metrics collector failed")
+        for name, (kind, samples) in sorted(collected.items()):
+            header(name, kind)
+            for labels, value in samples:
+                out.append(f"{name}{self._fmt_labels(sorted(labels.items()))} {value:g}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("bot_handler_seconds", "Update handler latency.")
+METRICS.describe("bot_handler_errors_total", "Update handlers that raised.")
+METRICS.describe("bot_upstream_seconds", "Outbound API call latency (one attempt).")
+METRICS.describe("bot_upstream_requests_total", "Outbound API calls by status.")
+METRICS.describe("bot_telegram_api_seconds", "Bot API call latency, excluding rate-limit waits.")
+METRICS.describe("bot_media_stage_seconds", "Media job stage durations (queue, download, transcode, upload).")
+METRICS.describe("bot_event_loop_lag_seconds", "Event loop scheduling delay.", LAG_BUCKETS)
+
+def instrumented(handler: str):
+    """Decorator for update handlers: latency histogram + error counter under `handler`."""
+    def wrap(fn):
+        @wraps(fn)
+        async def inner(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                METRICS.inc("bot_handler_errors_total", handler=handler)
+                raise
+            finally:
+                METRICS.observe("bot_handler_seconds", time.perf_counter() - t0, handler=handler)
+        return inner
+    return wrap
+
+# ========= Shared async HTTP client =========
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = 0.5          # base seconds for exponential backoff (full jitter)
+HTTP_BACKOFF_MAX = 8.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Max in-flight requests per upstream host, so one slow API can't eat the whole pool.
+HOST_LIMITS = {
+    "www.googleapis.com": int(os.getenv("YT_CONCURRENCY", "8")),
+    "itunes.apple.com": int(os.getenv("ITUNES_CONCURRENCY", "16")),
+    "generativelanguage.googleapis.com": int(os.getenv("GEMINI_CONCURRENCY", "4")),
+}
+HOST_LIMIT_DEFAULT = 8
+UPSTREAM_NAMES = {"www.googleapis.com": "youtube", "itunes.apple.com": "itunes",
+                  "generativelanguage.googleapis.com": "gemini"}   # metrics label per host
+_http: Optional[httpx.AsyncClient] = None
+_host_sems: Dict[str, asyncio.Semaphore] = {}
+
+def http() -> httpx.AsyncClient:
+    """One pooled keep-alive client for every outbound API call."""
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+        )
+    return _http
+
+def _host_sem(host: str) -> asyncio.Semaphore:
+    sem = _host_sems.get(host)
+    if sem is None:
+        sem = _host_sems[host] = asyncio.Semaphore(HOST_LIMITS.get(host, HOST_LIMIT_DEFAULT))
+    return sem
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    if retry_after:
+        try: return min(float(retry_after), HTTP_BACKOFF_MAX)
+        except ValueError: pass
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+async def http_request(method: str, url: str, *, retries: int = HTTP_RETRIES,
+                       timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+    """Sends a request through the shared client under the host's concurrency limit.
+    Retries transport errors and 429/5xx with jittered backoff; raises on final failure."""
+    host = httpx.URL(url).host
+    sem, upstream = _host_sem(host), UPSTREAM_NAMES.get(host, host)
+    for attempt in range(retries + 1):
+        try:
+            async with sem:
+                with METRICS.timer("bot_upstream_seconds", upstream=upstream):
+                    r = await http().request(method, url, timeout=timeout or HTTP_TIMEOUT, **kwargs)
+        except httpx.TransportError as e:
+            METRICS.inc("bot_upstream_requests_total", upstream=upstream, status=type(e).__name__)
+            if attempt >= retries:
+                raise
+            log.info("HTTP %s %s failed (%s), retrying", method, httpx.URL(url).host, type(e).__name__)
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        METRICS.inc("bot_upstream_requests_total", upstream=upstream, status=str(r.status_code))
+        if r.status_code in RETRY_STATUS and attempt < retries:
+            log.info("HTTP %s %s -> %d, retrying", method, httpx.URL(url).host, r.status_code)
+            await asyncio.sleep(_backoff(attempt, r.headers.get("Retry-After")))
+            continue
+        r.raise_for_status()
+        return r
+    raise RuntimeError("unreachable")
+
+@asynccontextmanager
+async def http_stream(method: str, url: str, *, retries: int = HTTP_RETRIES,
+                      timeout: Optional[float] = None, **kwargs) -> AsyncIterator[httpx.Response]:
+    """Streaming variant of http_request(). Transport errors and 429/5xx are retried like there,
+    but only before the body is handed out (a half-consumed stream can't be replayed). The host
+    slot is held until the response headers arrive, not for the whole (possibly long) body."""
+    host = httpx.URL(url).host
+    sem, upstream = _host_sem(host), UPSTREAM_NAMES.get(host, host)
+    client = http()
+    for attempt in range(retries + 1):
+        t0 = time.perf_counter()
+        try:
+            async with sem:
+                r = await client.send(client.build_request(method, url, timeout=timeout or HTTP_TIMEOUT, **kwargs),
+                                      stream=True)
+        except httpx.TransportError as e:
+            METRICS.inc("bot_upstream_requests_total", upstream=upstream, status=type(e).__name__)
+            if attempt >= retries:
+                raise
+            log.info("HTTP %s %s failed (%s), retrying", method, host, type(e).__name__)
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        METRICS.inc("bot_upstream_requests_total", upstream=upstream, status=str(r.status_code))
+        if r.status_code in RETRY_STATUS and attempt < retries:
+            await r.aclose()
+            log.info("HTTP %s %s -> %d, retrying", method, host, r.status_code)
+            await asyncio.sleep(_backoff(attempt, r.headers.get("Retry-After")))
+            continue
+        break
+    try:
+        if r.is_error:
+            await r.aread()
+            r.raise_for_status()
+        yield r
+    finally:
+        await r.aclose()
+        METRICS.observe("bot_upstream_seconds", time.perf_counter() - t0, upstream=upstream)
+
+async def close_http():
+    if _http is not None:
+        await _http.aclose()
+
+# ========= Outbound Telegram rate limiting =========
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))          # messages/s for the whole bot
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))               # messages/s per private chat
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))    # messages/s per group
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "2"))
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0   # set from RetryAfter
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def full(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+    async def acquire(self) -> float:
+        """Takes one token, sleeping as needed; returns the seconds waited."""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                delay = self.blocked_until - now
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            else:
+                delay = (1 - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Central scheduler for every Bot API call that targets a chat: a global token bucket plus
+    one per chat (stricter for groups). RetryAfter pauses only the affected chat (or everything,
+    for chat-less calls) and the request is retried up to max_retries times."""
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 group_rate: float = TG_GROUP_RATE, burst: int = TG_CHAT_BURST, max_retries: int = TG_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate, self.group_rate, self.burst = chat_rate, group_rate, burst
+        self.max_retries = max_retries
+        self._chats: Dict[Any, TokenBucket] = {}
+        self.calls = self.throttled = self.retry_afters = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1024:   # drop idle buckets; a full bucket carries no state
+                for cid in [c for c, b in self._chats.items() if b.full()]:
+                    del self._chats[cid]
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = self._chats[chat_id] = TokenBucket(self.group_rate if is_group else self.chat_rate, self.burst)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.calls += 1
+        chat_id = data.get("chat_id")
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        for attempt in range(retries + 1):
+            if bucket is not None:
+                waited = await bucket.acquire() + await self.global_bucket.acquire()
+                if waited:
+                    self.throttled += 1
+            elif self.global_bucket.blocked_until > time.monotonic():
+                await asyncio.sleep(self.global_bucket.blocked_until - time.monotonic())
+            try:
+                with METRICS.timer("bot_telegram_api_seconds", endpoint=endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_afters += 1
+                ra = e.retry_after
+                delay = (ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)) + 0.1
+                (bucket or self.global_bucket).blocked_until = time.monotonic() + delay
+                log.warning("Flood control on %s (chat %s): retry after %.1fs", endpoint, chat_id, delay)
+                if attempt >= retries:
+                    raise
+        raise RuntimeError("unreachable")
+
+    def stats_line(self) -> str:
+        return (f"telegram: {self.calls} API calls, {self.throttled} throttled, "
+                f"{self.retry_afters} RetryAfter, {len(self._chats)} chat buckets")
+
+TG_LIMITER = TokenBucketRateLimiter()
+
+# ========= Shared state backend =========
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")   # "sqlite" (shared by workers on one host) | "memory"
+STATE_DB_PATH = Path(os.getenv("STATE_DB_PATH", str(Path(__file__).with_name("state.db"))))
+STATE_LOCAL_TTL = float(os.getenv("STATE_LOCAL_TTL", "5"))   # max staleness of another worker's writes
+STATE_WRITE_INTERVAL = float(os.getenv("STATE_WRITE_INTERVAL", "0.5"))   # seconds between write-behind commits
+
+class StateBackend:
+    """Namespaced key/value store for everything workers must agree on (modes, prefs, users,
+    caches). Values must be JSON-serialisable; ttl is in seconds."""
+
+    persistent = False
+
+    def get(self, ns: str, key: str) -> Any:
+        return self.get_with_expiry(ns, key)[0]
+
+    def get_with_expiry(self, ns: str, key: str) -> Tuple[Any, Optional[float]]:
+        """(value, expires_at | None); (None, None) when missing or expired."""
+        raise NotImplementedError
+
+    def set(self, ns: str, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def set_many(self, ns: str, items: Dict[str, Any], ttl: Optional[float] = None):
+        for key, value in items.items():
+            self.set(ns, key, value, ttl)
+
+    def delete(self, ns: str, key: str):
+        raise NotImplementedError
+
+    def items(self, ns: str) -> List[Tuple[str, Any]]:
+        raise NotImplementedError
+
+    def items_page(self, ns: str, after: str, limit: int) -> List[Tuple[str, Any]]:
+        """Up to `limit` items with key > after, in key order (keyset pagination)."""
+        return sorted((kv for kv in self.items(ns) if kv[0] > after), key=lambda kv: kv[0])[:limit]
+
+    def count(self, ns: str) -> int:
+        return len(self.items(ns))
+
+    def count_with(self, ns: str, field: str) -> int:
+        """Entries whose (dict) value has a non-empty `field`."""
+        return sum(1 for _, v in self.items(ns) if isinstance(v, dict) and v.get(field))
+
+    def purge_expired(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+class MemoryBackend(StateBackend):
+    """Process-local backend (single worker, tests, benchmarks)."""
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, tuple]] = {}   # ns -> key -> (expires_at | None, value)
+
+    def get_with_expiry(self, ns, key):
+        item = self._data.get(ns, {}).get(key)
+        if item is None or (item[0] is not None and item[0] < time.time()):
+            return None, None
+        return item[1], item[0]
+
+    def set(self, ns, key, value, ttl=None):
+        self._data.setdefault(ns, {})[key] = (time.time() + ttl if ttl else None, value)
+
+    def delete(self, ns, key):
+        self._data.get(ns, {}).pop(key, None)
+
+    def items(self, ns):
+        now = time.time()
+        return [(k, v) for k, (exp, v) in self._data.get(ns, {}).items() if exp is None or exp >= now]
+
+    def purge_expired(self):
+        now, n = time.time(), 0
+        for bucket in self._data.values():
+            for k in [k for k, (exp, _) in bucket.items() if exp is not None and exp < now]:
+                del bucket[k]; n += 1
+        return n
+
+class SQLiteBackend(StateBackend):
+    """One WAL-mode SQLite file; any number of worker processes on the host can share it."""
+
+    persistent = True
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS kv (ns TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (ns, key))"
+        )
+        self._db.commit()
+        # Every thread reads through its own connection: under WAL readers never wait for a commit,
+        # and a long scan in a worker thread (/stats) can't hold up point reads on the event loop.
+        self._path = path
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+
+    def _reader(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(str(self._path), check_same_thread=False, timeout=30)
+            with self._lock:
+                self._readers.append(db)
+        return db
+
+    def _write(self, sql: str, rows: List[tuple]):
+        with self._lock:
+            self._db.executemany(sql, rows)
+            self._db.commit()
+
+    def write_batch(self, rows: List[tuple], deletes: List[tuple]):
+        """rows: (ns, key, value, expires_at | None); deletes: (ns, key). One transaction."""
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO kv VALUES (?,?,?,?)",
+                                 [(ns, k, json.dumps(v, ensure_ascii=False), exp) for ns, k, v, exp in rows])
+            self._db.executemany("DELETE FROM kv WHERE ns=? AND key=?", deletes)
+            self._db.commit()
+
+    def get_with_expiry(self, ns, key):
+        row = self._reader().execute("SELECT value, expires FROM kv WHERE ns=? AND key=?", (ns, key)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def set(self, ns, key, value, ttl=None):
+        self._write("INSERT OR REPLACE INTO kv VALUES (?,?,?,?)",
+                    [(ns, key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None)])
+
+    def set_many(self, ns, items, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self._write("INSERT OR REPLACE INTO kv VALUES (?,?,?,?)",
+                    [(ns, k, json.dumps(v, ensure_ascii=False), expires) for k, v in items.items()])
+
+    def delete(self, ns, key):
+        self._write("DELETE FROM kv WHERE ns=? AND key=?", [(ns, key)])
+
+    def items(self, ns):
+        rows = self._reader().execute(
+            "SELECT key, value FROM kv WHERE ns=? AND (expires IS NULL OR expires >= ?)", (ns, time.time())
+        ).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def items_page(self, ns, after, limit):
+        rows = self._reader().execute(
+            "SELECT key, value FROM kv WHERE ns=? AND key>? AND (expires IS NULL OR expires >= ?) "
+            "ORDER BY key LIMIT ?", (ns, after, time.time(), limit)
+        ).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def count(self, ns):
+        return self._reader().execute(
+            "SELECT COUNT(*) FROM kv WHERE ns=? AND (expires IS NULL OR expires >= ?)", (ns, time.time())
+        ).fetchone()[0]
+
+    def count_with(self, ns, field):
+        return self._reader().execute(
+            "SELECT COUNT(*) FROM kv WHERE ns=? AND (expires IS NULL OR expires >= ?) "
+            "AND json_extract(value, '$.' || ?) IS NOT NULL AND json_extract(value, '$.' || ?) != ''",
+            (ns, time.time(), field, field)
+        ).fetchone()[0]
+
+    def purge_expired(self):
+        with self._lock:
+            n = self._db.execute("DELETE FROM kv WHERE expires < ?", (time.time(),)).rowcount
+            self._db.commit()
+        return n
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            for db in self._readers:
+                db.close()
+
+_DELETED = object()
+
+class WriteBehindBackend(StateBackend):
+    """Keeps commits off the event loop: writes land in a pending map (this worker's reads see them
+    at once) and run_flusher() commits everything pending in one transaction per tick from a
+    worker thread. Scans (items/count/...) flush first, so they always see this worker's writes."""
+
+    persistent = True
+
+    def __init__(self, inner: SQLiteBackend):
+        self.inner = inner
+        self._lock = threading.Lock()          # guards _pending/_flushing
+        self._flush_lock = threading.Lock()    # one batch in flight at a time
+        self._pending: Dict[Tuple[str, str], tuple] = {}    # (ns, key) -> (value | _DELETED, expires_at | None)
+        self._flushing: Dict[Tuple[str, str], tuple] = {}   # the batch being committed right now
+        self.commits = self.written = 0
+
+    def get_with_expiry(self, ns, key):
+        with self._lock:
+            item = self._pending.get((ns, key)) or self._flushing.get((ns, key))
+        if item is None:
+            return self.inner.get_with_expiry(ns, key)
+        value, expires = item
+        if value is _DELETED or (expires is not None and expires < time.time()):
+            return None, None
+        return value, expires
+
+    def set(self, ns, key, value, ttl=None):
+        with self._lock:
+            self._pending[(ns, key)] = (value, time.time() + ttl if ttl else None)
+
+    def set_many(self, ns, items, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._pending.update({(ns, k): (v, expires) for k, v in items.items()})
+
+    def delete(self, ns, key):
+        with self._lock:
+            self._pending[(ns, key)] = (_DELETED, None)
+
+    def items(self, ns):
+        self.flush()
+        return self.inner.items(ns)
+
+    def items_page(self, ns, after, limit):
+        self.flush()
+        return self.inner.items_page(ns, after, limit)
+
+    def count(self, ns):
+        self.flush()
+        return self.inner.count(ns)
+
+    def count_with(self, ns, field):
+        self.flush()
+        return self.inner.count_with(ns, field)
+
+    def purge_expired(self):
+        self.flush()
+        return self.inner.purge_expired()
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """Commits everything pending; blocking, so call it from a worker thread."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+            if not batch:
+                return 0
+            try:
+                self.inner.write_batch(
+                    [(ns, k, v, exp) for (ns, k), (v, exp) in batch.items() if v is not _DELETED],
+                    [(ns, k) for (ns, k), (v, _) in batch.items() if v is _DELETED])
+            except Exception:
+                with self._lock:
+                    self._pending = {**batch, **self._pending}   # newer writes win; retried next tick
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            self.commits += 1
+            self.written += len(batch)
+            return len(batch)
+
+    async def run_flusher(self, interval: float = STATE_WRITE_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                log.warning("State write-behind commit failed: %s", e)
+
+    def close(self):
+        self.flush()
+        self.inner.close()
+
+STATE: Optional[StateBackend] = None
+
+def state() -> StateBackend:
+    global STATE
+    if STATE is None:
+        STATE = WriteBehindBackend(SQLiteBackend(STATE_DB_PATH)) if STATE_BACKEND == "sqlite" else MemoryBackend()
+    return STATE
+
+async def run_state_maintenance(interval: float = 600):
+    while True:
+        await asyncio.sleep(interval)
+        n = await asyncio.to_thread(state().purge_expired)
+        if n:
+            log.info("Purged %d expired state entries", n)
+
+class TTLCache:
+    """Bounded LRU map whose entries also expire after `ttl` seconds.
+    With shared=True a persistent state backend is used as a second tier: writes go through to
+    it and local misses are read from it, so caches survive restarts and are shared by workers."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float, shared: bool = False):
+        self.name, self.maxsize, self.ttl, self.shared = name, maxsize, ttl, shared
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (expires_at, value)
+        self.hits = self.misses = 0
+
+    def _backend(self) -> Optional[StateBackend]:
+        return state() if self.shared and state().persistent else None
+
+    def get(self, key: str, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.time():
+            if item is not None:
+                del self._data[key]
+            backend = self._backend()
+            value, expires = backend.get_with_expiry(f"cache:{self.name}", key) if backend else (None, None)
+            if value is None:
+                self.misses += 1
+                return default
+            # keep the backend's deadline, so the local copy can't outlive the shared one
+            self._store(key, value, self.ttl if expires is None else min(self.ttl, expires - time.time()))
+            item = self._data[key]
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def _store(self, key: str, value, ttl: float):
+        self._data[key] = (time.time() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._store(key, value, ttl)
+        backend = self._backend()
+        if backend:
+            backend.set(f"cache:{self.name}", key, value, ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        for key, value in items.items():
+            self._store(key, value, ttl)
+        backend = self._backend()
+        if backend and items:
+            backend.set_many(f"cache:{self.name}", items, ttl)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats_line(self) -> str:
+        total = self.hits + self.misses
+        rate = f"{100 * self.hits / total:.0f}%" if total else "—"
+        return f"{self.name}: {len(self)}/{self.maxsize} entries, {self.hits} hits / {self.misses} misses ({rate})"
+
+_ABSENT = object()
+
+class SharedDict:
+    """Read-through view of one backend namespace, with a short-lived local cache in front so
+    hot keys (a user's mode/prefs on every message) don't hit the backend each time."""
+
+    def __init__(self, ns: str, local_ttl: float = STATE_LOCAL_TTL, maxsize: int = 50_000):
+        self.ns = ns
+        self._local = TTLCache(f"{ns}-local", maxsize, local_ttl)
+
+    def get(self, key, default=None):
+        key = str(key)
+        value = self._local.get(key, _ABSENT)
+        if value is _ABSENT:
+            value = state().get(self.ns, key)
+            self._local.set(key, value)   # None is cached too, as "not set"
+        return default if value is None else value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        key = str(key)
+        state().set(self.ns, key, value, ttl)
+        self._local.set(key, value)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
 
 # ========= State & Simple analytics =========
-user_mode: Dict[int, str] = {}   # user_id -> "music" | "ai"
-USER_PREFS: Dict[int, Dict[str, str]] = {}  # user_id -> {"source": "youtube"/"apple", "country": "eg"}
-USERS_PATH = Path(__file__).with_name("users.json")
+user_mode = SharedDict("mode")      # user_id -> "music" | "ai"
+USER_PREFS = SharedDict("prefs")    # user_id -> {"source": "youtube"/"apple", "country": "eg"}
+USERS_PATH = Path(__file__).with_name("users.json")   # legacy registry, imported once into the state backend
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))  # seconds between batched writes
+USERS_LOAD_PAGE = int(os.getenv("USERS_LOAD_PAGE", "2000"))           # registry rows per startup read
 USERS: Dict[str, Dict[str, str]] = {}
 
-def load_users():
-    global USERS
-    if USERS_PATH.exists():
+class UserStore:
+    """User registry in the state backend's "users" namespace. Updates are marked dirty in memory
+    and written in batches by a background flusher, so touching a user costs O(1)."""
+
+    NS = "users"
+    FIELDS = ("username", "first_name", "last_name")
+
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+        self.dirty: set = set()
+
+    def load(self) -> Dict[str, Dict[str, str]]:
+        return {uid: {f: (info or {}).get(f, "") for f in self.FIELDS} for uid, info in self.backend.items(self.NS)}
+
+    def import_json(self, path: Path) -> int:
+        """One-time migration of the old users.json file; returns number of imported users."""
         try:
-            USERS = json.loads(USERS_PATH.read_text(encoding="utf-8"))
-        except Exception:
-            USERS = {}
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            log.warning("Reading %s failed: %s", path, e)
+            return 0
+        self.backend.set_many(self.NS, {str(uid): {f: info.get(f, "") for f in self.FIELDS}
+                                        for uid, info in data.items()})
+        return len(data)
+
+    async def load_into(self, users: Dict[str, Dict[str, str]], page: int = USERS_LOAD_PAGE) -> int:
+        """Streams the registry into `users` one key-ordered page at a time, off the event loop.
+        Records touched while this runs are newer than the stored ones and are kept."""
+        if USERS_PATH.exists() and await asyncio.to_thread(self.backend.count, self.NS) == 0:
+            n = await asyncio.to_thread(self.import_json, USERS_PATH)
+            log.info("Imported %d users from %s", n, USERS_PATH.name)
+        after, total = "", 0
+        while True:
+            rows = await asyncio.to_thread(self.backend.items_page, self.NS, after, page)
+            for uid, info in rows:
+                users.setdefault(uid, {f: (info or {}).get(f, "") for f in self.FIELDS})
+            total += len(rows)
+            if len(rows) < page:
+                return total
+            after = rows[-1][0]
+
+    def mark_dirty(self, uid: str):
+        self.dirty.add(uid)
+
+    def flush(self, users: Dict[str, Dict[str, str]]) -> int:
+        if not self.dirty:
+            return 0
+        batch, self.dirty = self.dirty, set()
+        rows = {uid: users[uid] for uid in batch if uid in users}
+        try:
+            self.backend.set_many(self.NS, rows)
+        except Exception as e:
+            self.dirty |= batch   # retry on the next tick
+            log.warning("Saving users failed: %s", e)
+            return 0
+        return len(rows)
+
+    async def run_flusher(self, users: Dict[str, Dict[str, str]], interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.flush, users)
+
+USER_STORE: Optional[UserStore] = None
+
+def load_users():
+    """Opens the registry; the records themselves are streamed in by warm_up() once the bot runs."""
+    global USER_STORE
+    if USER_STORE is None:
+        USER_STORE = UserStore(state())
 
 def save_users():
-    try:
-        USERS_PATH.write_text(json.dumps(USERS, ensure_ascii=False, indent=2), encoding="utf-8")
-    except Exception as e:
-        log.warning("Saving users failed: %s", e)
+    """Synchronously writes all pending user updates (used on shutdown)."""
+    if USER_STORE is not None:
+        USER_STORE.flush(USERS)
 
 def touch_user(update: Update):
     u = update.effective_user
     if not u: return
     uid = str(u.id)
-    USERS.setdefault(uid, {})
-    USERS[uid]["username"]   = u.username or ""
-    USERS[uid]["first_name"] = u.first_name or ""
-    USERS[uid]["last_name"]  = u.last_name or ""
-    save_users()
+    rec = {"username": u.username or "", "first_name": u.first_name or "", "last_name": u.last_name or ""}
+    if USERS.get(uid) == rec:
+        return
+    USERS[uid] = rec
+    if USER_STORE is not None:
+        USER_STORE.mark_dirty(uid)
 
 def set_pref(uid: int, key: str, val: str):
-    USER_PREFS.setdefault(uid, {})[key] = val
+    prefs = dict(USER_PREFS.get(uid) or {})
+    prefs[key] = val
+    USER_PREFS[uid] = prefs
 
 def get_pref(uid: int, key: str, default: Optional[str]=None) -> Optional[str]:
-    return USER_PREFS.get(uid, {}).get(key, default)
+    return (USER_PREFS.get(uid) or {}).get(key, default)
 
 # ========= Utils =========
 
@@ -76,6 +920,88 @@ def norm_text(s: str) -> str:
     return s
 
 
+# ========= Caches =========
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(6 * 3600)))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+TRACK_CACHE_TTL = float(os.getenv("TRACK_CACHE_TTL", str(24 * 3600)))
+TRACK_CACHE_SIZE = int(os.getenv("TRACK_CACHE_SIZE", "20000"))
+
+SEARCH_CACHE = TTLCache("search", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, shared=True)
+TRACK_CACHE = TTLCache("tracks", TRACK_CACHE_SIZE, TRACK_CACHE_TTL, shared=True)
+CACHES = [SEARCH_CACHE, TRACK_CACHE]
+
+def search_key(source: str, query: str, *extra) -> str:
+    return "|".join([source, norm_text(query).lower(), *map(str, extra)])
+
+
+# ========= Callback payload registry =========
+# callback_data is capped at 64 bytes, so buttons carry "<kind>|<short id>" and the payload
+# (query, track, ...) lives here. Shared tier => any worker can answer any button.
+CALLBACK_TTL = float(os.getenv("CALLBACK_TTL", str(7 * 24 * 3600)))
+CALLBACK_STORE = TTLCache("callbacks", int(os.getenv("CALLBACK_STORE_SIZE", "50000")), CALLBACK_TTL, shared=True)
+CACHES.append(CALLBACK_STORE)
+
+def cb_put(kind: str, payload: Dict[str, Any]) -> str:
+    """Stores payload and returns the callback_data for it."""
+    cid = secrets.token_urlsafe(6)   # 8 chars
+    CALLBACK_STORE.set(cid, payload)
+    return f"{kind}|{cid}"
+
+def cb_get(cid: str) -> Optional[Dict[str, Any]]:
+    return CALLBACK_STORE.get(cid)
+
+
+# ========= Request coalescing =========
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one in-flight task (Go's singleflight).
+    The job runs as its own task, so a caller going away doesn't cancel it for the others."""
+
+    def __init__(self, top_n: int = 50):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.waiters: Dict[str, int] = {}     # in-flight key -> callers attached, leader included
+        self.started: Dict[str, int] = {}     # key kind ("yt_dl", "apple", ...) -> jobs actually run
+        self.coalesced: Dict[str, int] = {}   # key kind -> callers that reused someone else's job
+        self.top_n = top_n
+        self.hot: Dict[str, int] = {}         # key -> callers coalesced onto it, only the top_n busiest kept
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._tasks
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            self.waiters.pop(key, None)
+        if not task.cancelled():
+            task.exception()   # mark retrieved even if every caller went away
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, shared); shared is True when another caller's job produced it."""
+        kind = key.split("|", 1)[0]
+        task = self._tasks.get(key)
+        shared = task is not None
+        if task is None:
+            task = self._tasks[key] = asyncio.create_task(fn())
+            task.add_done_callback(lambda t: self._done(key, t))
+            self.started[kind] = self.started.get(kind, 0) + 1
+        else:
+            self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+            self.hot[key] = self.hot.get(key, 0) + 1
+            if len(self.hot) > 2 * self.top_n:
+                self.hot = dict(heapq.nlargest(self.top_n, self.hot.items(), key=lambda kv: kv[1]))
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        return await asyncio.shield(task), shared
+
+    def stats_line(self) -> str:
+        kinds = sorted(set(self.started) | set(self.coalesced))
+        parts = [f"{k} {self.started.get(k, 0)} run / {self.coalesced.get(k, 0)} joined" for k in kinds]
+        hot = [f"{k[:40]} ×{n}" for k, n in heapq.nlargest(3, self.hot.items(), key=lambda kv: kv[1])]
+        return ("coalescing: " + (", ".join(parts) or "—") + f" ({len(self._tasks)} in flight)"
+                + (f"; hottest: {', '.join(hot)}" if hot else ""))
+
+FLIGHTS = SingleFlight()
+
+
 def main_menu(user_id: Optional[int] = None) -> ReplyKeyboardMarkup:
     kb = [
         ["🎵 أغاني", "🤖 AI Chat"],
@@ -90,8 +1016,8 @@ def main_menu(user_id: Optional[int] = None) -> ReplyKeyboardMarkup:
 
 def source_choice_kb(query: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[
-        InlineKeyboardButton("🍎 Apple",  callback_data=f"src|apple|{urllib.parse.quote(query)}"),
-        InlineKeyboardButton("▶️ YouTube", callback_data=f"src|youtube|{urllib.parse.quote(query)}"),
+        InlineKeyboardButton("🍎 Apple",  callback_data=cb_put("src", {"src": "apple", "query": query})),
+        InlineKeyboardButton("▶️ YouTube", callback_data=cb_put("src", {"src": "youtube", "query": query})),
     ]])
 
 # ========= Title normalization & de-dup helpers =========
@@ -102,19 +1028,28 @@ BAD_WORDS = {
     "karaoke", "cover", "sped up", "slowed", "nightcore", "8d", "4k", "live"
 }
 
+# Longest phrases first, so "official audio" wins over "audio" wherever both could match.
+_BAD_WORDS_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(w) for w in sorted(BAD_WORDS, key=lambda w: (-len(w), w))) + r")\b"
+)
+_PARENS_RE = re.compile(r"\([^)]*\)")
+_BRACKETS_RE = re.compile(r"\[[^\]]*\]")
+_BRACES_RE = re.compile(r"\{[^}]*\}")
+_TITLE_JUNK_RE = re.compile(r"[^a-z0-9\u0621-\u064A\s\-]+")
+_TITLE_PUNCT = str.maketrans({"—": "-", "–": "-", "|": " "})
+
+@lru_cache(maxsize=50_000)
 def norm_song_title(raw: str) -> str:
     if not raw:
         return ""
     s = raw.lower()
-    s = re.sub(r"\([^)]*\)", " ", s)
-    s = re.sub(r"\[[^\]]*\]", " ", s)
-    s = re.sub(r"\{[^}]*\}", " ", s)
-    s = s.replace("—", "-").replace("–", "-").replace("|", " ")
-    for w in BAD_WORDS:
-        s = re.sub(rf"\b{re.escape(w)}\b", " ", s)
-    s = re.sub(r"[^a-z0-9\u0621-\u064A\s\-]+", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    s = _PARENS_RE.sub(" ", s)
+    s = _BRACKETS_RE.sub(" ", s)
+    s = _BRACES_RE.sub(" ", s)
+    s = s.translate(_TITLE_PUNCT)
+    s = _BAD_WORDS_RE.sub(" ", s)
+    s = _TITLE_JUNK_RE.sub(" ", s)
+    return " ".join(s.split())
 
 
 def dedup_youtube(items: List[Dict[str, str]], limit=5) -> List[Dict[str, str]]:
@@ -146,13 +1081,104 @@ def dedup_apple(items: List[Dict[str, Any]], limit=10) -> List[Dict[str, Any]]:
     return out
 
 # ========= YouTube (Data API search; Music-only + dedupe) =========
+YT_DAILY_QUOTA = int(os.getenv("YT_DAILY_QUOTA", "10000"))   # units per key per day
+YT_SEARCH_COST = 100                                          # search.list price in quota units
+YT_QUOTA_RESERVE = int(os.getenv("YT_QUOTA_RESERVE", "0"))   # units per key kept back for emergencies
+YT_SEARCH_FALLBACK = os.getenv("YT_SEARCH_FALLBACK", "1") == "1"   # yt-dlp ytsearch when no quota is left
+
+class QuotaExceeded(Exception):
+    pass
+
+class YouTubeQuota:
+    """Counts Data API units per key per quota day (midnight Pacific, like Google), shared through
+    the state backend so all workers draw from the same budget. Counts are approximate across
+    workers (read-modify-write), which is fine for picking keys and deciding when to fall back."""
+
+    NS = "yt_quota"
+
+    def __init__(self, keys: List[str], daily: int, reserve: int):
+        self.keys, self.daily, self.reserve = keys, daily, reserve
+        self.api_searches = self.fallback_searches = 0
+        self._used = SharedDict(self.NS)   # other workers' charges show up within STATE_LOCAL_TTL
 
-def yt_api_search(query: str, max_results: int = 12) -> List[Dict[str, str]]:
-    if not YT_API_KEY:
+    @staticmethod
+    def day() -> str:
+        try:
+            tz = ZoneInfo("America/Los_Angeles")
+        except ZoneInfoNotFoundError:
+            tz = timezone(timedelta(hours=-8))
+        return datetime.now(tz).strftime("%Y-%m-%d")
+
+    def used(self, api_key: str) -> int:
+        return self._used.get(f"{self.day()}|{api_key}", 0)
+
+    def remaining(self, api_key: str) -> int:
+        return max(0, self.daily - self.used(api_key))
+
+    def pick_key(self, cost: int = YT_SEARCH_COST) -> Optional[str]:
+        """Key with the most units left, or None if none can afford `cost`."""
+        best = max(self.keys, key=self.remaining, default=None)
+        if best is None or self.remaining(best) - cost < self.reserve:
+            return None
+        return best
+
+    def charge(self, api_key: str, units: int):
+        self._used.set(f"{self.day()}|{api_key}", self.used(api_key) + units, ttl=2 * 86400)
+
+    def exhaust(self, api_key: str):
+        log.warning("YouTube API key …%s is out of quota for %s", api_key[-4:], self.day())
+        self._used.set(f"{self.day()}|{api_key}", self.daily, ttl=2 * 86400)
+
+    def stats_line(self) -> str:
+        left = [f"…{k[-4:]} {self.remaining(k)}" for k in self.keys]
+        return (f"youtube quota: {sum(self.remaining(k) for k in self.keys)}/{self.daily * len(self.keys)} units left"
+                + (f" ({', '.join(left)})" if left else "")
+                + f"; {self.api_searches} API / {self.fallback_searches} yt-dlp searches")
+
+YT_QUOTA = YouTubeQuota(YT_API_KEYS, YT_DAILY_QUOTA, YT_QUOTA_RESERVE)
+
+async def yt_api_search(query: str, max_results: int = 12) -> List[Dict[str, str]]:
+    if not YT_API_KEYS and not YT_SEARCH_FALLBACK:
         return []
+    key = search_key("youtube", query, max_results)
+    cached = SEARCH_CACHE.get(key)
+    if cached is not None:
+        return cached
+    return (await FLIGHTS.do(key, lambda: _yt_search_fetch(query, max_results, key)))[0]
+
+
+async def _yt_search_fetch(query: str, max_results: int, key: str) -> List[Dict[str, str]]:
+    """Data API with the key that has most quota left; yt-dlp search when quota (or the API) fails."""
+    raw = None
+    while raw is None and (api_key := YT_QUOTA.pick_key()):
+        try:
+            raw = await _yt_data_api(query, max_results, api_key)
+            YT_QUOTA.api_searches += 1
+        except QuotaExceeded:
+            YT_QUOTA.exhaust(api_key)
+        except Exception as e:
+            log.warning("YouTube API error: %s", e)
+            break
+    if raw is None and YT_SEARCH_FALLBACK:
+        try:
+            raw = await SEARCH_POOL.submit(ytdlp_search_job, query, max_results, priority=PRIORITY_SEARCH,
+                                           label=f"ytsearch|{query}")
+            YT_QUOTA.fallback_searches += 1
+        except QueueFull:
+            log.warning("yt-dlp search queue full, turning away %r", query)
+            raise   # callers say "busy" rather than "no results"
+        except Exception as e:
+            log.warning("yt-dlp search error: %s", e)
+    results = dedup_youtube(raw or [], limit=max_results)
+    if results:
+        SEARCH_CACHE.set(key, results)
+    return results
+
+
+async def _yt_data_api(query: str, max_results: int, api_key: str) -> List[Dict[str, str]]:
     url = "https://www.googleapis.com/youtube/v3/search"
     params = {
-        "key": YT_API_KEY,
+        "key": api_key,
         "q": query,
         "type": "video",
         "part": "snippet",
@@ -162,51 +1188,86 @@ def yt_api_search(query: str, max_results: int = 12) -> List[Dict[str, str]]:
         "topicId": "/m/04rlf"      # Music topic
     }
     try:
-        r = requests.get(url, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        raw = []
-        for item in data.get("items", []):
-            vid = item["id"]["videoId"]
-            title = item["snippet"]["title"]
-            channel = item["snippet"].get("channelTitle", "")
-            raw.append({
-                "url": f"https://www.youtube.com/watch?v={vid}",
-                "title": title,
-                "channel": channel
+        r = await http_request("GET", url, params=params)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 403 and b"quota" in e.response.content.lower():
+            raise QuotaExceeded(api_key) from e
+        YT_QUOTA.charge(api_key, YT_SEARCH_COST)   # failed calls are billed too
+        raise
+    YT_QUOTA.charge(api_key, YT_SEARCH_COST)
+    data = r.json()
+    raw = []
+    for item in data.get("items", []):
+        vid = item["id"]["videoId"]
+        title = item["snippet"]["title"]
+        channel = item["snippet"].get("channelTitle", "")
+        raw.append({
+            "url": f"https://www.youtube.com/watch?v={vid}",
+            "title": title,
+            "channel": channel
+        })
+    return raw
+
+
+def ytdlp_search_job(query: str, n: int) -> List[Dict[str, str]]:
+    """Process-pool job: quota-free search through yt-dlp's ytsearchN: with flat extraction."""
+    opts = {"quiet": True, "extract_flat": True, "skip_download": True, "noplaylist": True}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(f"ytsearch{n}:{query}", download=False)
+    out = []
+    for e in info.get("entries") or []:
+        if e and e.get("id"):
+            out.append({
+                "url": f"https://www.youtube.com/watch?v={e['id']}",
+                "title": e.get("title") or "",
+                "channel": e.get("channel") or e.get("uploader") or "",
             })
-        return dedup_youtube(raw, limit=5)
-    except Exception as e:
-        log.warning("YouTube API error: %s", e)
-        return []
+    return out
+
 
+_YT_ID_RE = re.compile(r"(?:v=|youtu\.be/|/shorts/|/embed/)([A-Za-z0-9_-]{11})")
 
-def listen_kb_youtube(url: str, title: str) -> InlineKeyboardMarkup:
-    encoded_url = urllib.parse.quote(url)
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("▶️ Listen now (YouTube)", callback_data=f"yt_dl|{encoded_url}")],
-        [InlineKeyboardButton("🔗 Open link", url=url),
-         InlineKeyboardButton("🔎 Search again", switch_inline_query_current_chat=title)]
-    ])
+def youtube_video_id(url: str) -> Optional[str]:
+    m = _YT_ID_RE.search(url)
+    return m.group(1) if m else None
+
+
+def fmt_youtube_line(r: Dict[str, str], n: int) -> str:
+    pretty = norm_song_title(r['title']) or r['title']
+    return f"{n}. {pretty}" + (f" — {r['channel']}" if r.get('channel') else "")
+
+
+def results_kb_youtube(results: List[Dict[str, str]], query: str) -> InlineKeyboardMarkup:
+    # An 11-char video ID is already compact, so YouTube buttons need no registry entry.
+    rows = [[InlineKeyboardButton(f"▶️ {i}", callback_data=f"yt|{youtube_video_id(r['url'])}"),
+             InlineKeyboardButton(f"🔗 {i}", url=r["url"])]
+            for i, r in enumerate(results, 1)]
+    rows.append([InlineKeyboardButton("🔎 Search again", switch_inline_query_current_chat=query)])
+    return InlineKeyboardMarkup(rows)
 
 # ========= Apple (iTunes 30s preview) =========
 ITUNES_SEARCH = "https://itunes.apple.com/search"
 ITUNES_LOOKUP = "https://itunes.apple.com/lookup"
 COUNTRY_ORDER = ["eg","sa","ae","ma","us","gb"]
+APPLE_SEARCH_DEADLINE = float(os.getenv("APPLE_SEARCH_DEADLINE", "8"))  # seconds for the whole fan-out
+APPLE_GOOD_SCORE = 6.0   # score_match() of a track whose title contains the whole query
 
 
-def itunes_search(term: str, country: str, limit=8, attribute: Optional[str]=None) -> List[Dict[str, Any]]:
+async def itunes_search(term: str, country: str, limit=8, attribute: Optional[str]=None) -> List[Dict[str, Any]]:
     params = {"term": term, "entity": "song", "limit": limit, "country": country}
     if attribute: params["attribute"] = attribute
-    r = requests.get(ITUNES_SEARCH, params=params, timeout=15)
-    r.raise_for_status()
+    r = await http_request("GET", ITUNES_SEARCH, params=params)
     return r.json().get("results", [])
 
 
-def itunes_lookup(track_id: int) -> Optional[Dict[str, Any]]:
-    r = requests.get(ITUNES_LOOKUP, params={"id": track_id}, timeout=15)
-    r.raise_for_status()
+async def itunes_lookup(track_id: int) -> Optional[Dict[str, Any]]:
+    cached = TRACK_CACHE.get(str(track_id))
+    if cached is not None:
+        return cached
+    r = await http_request("GET", ITUNES_LOOKUP, params={"id": track_id})
     arr = r.json().get("results", [])
+    if arr:
+        TRACK_CACHE.set(str(track_id), arr[0])
     return arr[0] if arr else None
 
 
@@ -219,16 +1280,21 @@ def unique_by_trackid(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return out
 
 
+@lru_cache(maxsize=50_000)
+def _match_fields(text: str) -> Tuple[str, frozenset]:
+    low = text.lower()
+    return low, frozenset(low.split())
+
+
 def score_match(query: str, t: Dict[str, Any]) -> float:
-    q = query.lower()
-    name = (t.get("trackName") or "").lower()
-    artist = (t.get("artistName") or "").lower()
+    q, q_tokens = _match_fields(query)
+    name, name_tokens = _match_fields(t.get("trackName") or "")
+    artist, artist_tokens = _match_fields(t.get("artistName") or "")
     score = 0.0
     if q in name: score += 3
     if q in (name + " " + artist): score += 3
-    q_tokens = set(q.split())
-    score += len(q_tokens & set(name.split())) * 1.5
-    score += len(q_tokens & set(artist.split())) * 1.0
+    score += len(q_tokens & name_tokens) * 1.5
+    score += len(q_tokens & artist_tokens) * 1.0
     return score
 
 
@@ -236,41 +1302,432 @@ def best_n(query: str, tracks: List[Dict[str, Any]], n=6) -> List[Dict[str, Any]
     return sorted(tracks, key=lambda t: score_match(query, t), reverse=True)[:n]
 
 
-def comprehensive_apple_search(user_id: int, raw_query: str, limit_each=6) -> List[Dict[str, Any]]:
+async def comprehensive_apple_search(user_id: int, raw_query: str, limit_each=6,
+                                     deadline: float = APPLE_SEARCH_DEADLINE) -> List[Dict[str, Any]]:
+    """Queries every country x {songTerm, artistTerm} at once. Returns as soon as enough
+    high-scoring unique tracks have arrived or the deadline passes; stragglers are cancelled."""
     q = norm_text(raw_query)
     user_country = get_pref(user_id, "country")
+    key = search_key("apple", q, user_country or "", limit_each)
+    cached = SEARCH_CACHE.get(key)
+    if cached is not None:
+        return cached
     countries = [user_country] + [c for c in COUNTRY_ORDER if c != user_country] if user_country else COUNTRY_ORDER[:]
-    results: List[Dict[str, Any]] = []
-    for c in countries:
-        try: results += itunes_search(q, c, limit=limit_each, attribute="songTerm")
-        except: pass
-    for c in countries:
-        try: results += itunes_search(q, c, limit=limit_each, attribute="artistTerm")
-        except: pass
+    return (await FLIGHTS.do(key, lambda: _apple_fanout(q, countries, limit_each, deadline, key)))[0]
+
+
+async def _apple_fanout(q: str, countries: List[str], limit_each: int, deadline: float,
+                        key: str) -> List[Dict[str, Any]]:
+    jobs = [(c, attr) for attr in ("songTerm", "artistTerm") for c in countries]
+    tasks = {asyncio.create_task(itunes_search(q, c, limit=limit_each, attribute=attr)): i
+             for i, (c, attr) in enumerate(jobs)}
+    # Keep results in the original country/attribute order so ranking ties stay deterministic.
+    parts: List[List[Dict[str, Any]]] = [[] for _ in jobs]
+    good: Dict[str, Dict[str, Any]] = {}
+    pending = set(tasks)
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=end - loop.time(),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                log.info("Apple search deadline hit for %r (%d/%d answered)", q, len(jobs) - len(pending), len(jobs))
+                break
+            for fut in done:
+                if fut.exception():
+                    continue
+                parts[tasks[fut]] = fut.result()
+                for t in fut.result():
+                    if t.get("trackId") and score_match(q, t) >= APPLE_GOOD_SCORE:
+                        good.setdefault(t["trackId"], t)
+            if len(dedup_apple(list(good.values()), limit=10)) >= 10:
+                break
+    finally:
+        for fut in pending:
+            fut.cancel()
 
-    ranked = best_n(q, unique_by_trackid(results), n=30)
-    return dedup_apple(ranked, limit=10)
+    results = unique_by_trackid([t for part in parts for t in part])
+    # lets the play|<trackId> callback skip itunes_lookup()
+    TRACK_CACHE.set_many({str(t["trackId"]): t for t in results})
+    tracks = dedup_apple(best_n(q, results, n=30), limit=10)
+    if tracks:
+        SEARCH_CACHE.set(key, tracks)
+    return tracks
 
 
-def fmt_track_line(t: Dict[str, Any]) -> str:
+def fmt_track_line(t: Dict[str, Any], n: Optional[int] = None) -> str:
     name = t.get("trackName", "Unknown"); artist = t.get("artistName", "Unknown")
     album = t.get("collectionName", "")
-    return f"• {name} — {artist}" + (f" ({album})" if album else "")
+    return (f"{n}. " if n else "• ") + f"{name} — {artist}" + (f" ({album})" if album else "")
+
+
+def results_kb_apple(tracks: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    rows = []
+    for i, t in enumerate(tracks, 1):
+        yt_q = urllib.parse.quote(f"{t.get('trackName', '')} {t.get('artistName', '')}".strip())
+        preview = {k: t.get(k) for k in ("trackId", "trackName", "artistName", "previewUrl")}
+        row = [InlineKeyboardButton(f"▶️ {i}", callback_data=cb_put("play", {"track": preview}))]
+        if t.get("trackViewUrl"):
+            row.append(InlineKeyboardButton(f"🍎 {i}", url=t["trackViewUrl"]))
+        row.append(InlineKeyboardButton(f"📺 {i}", url=f"https://www.youtube.com/results?q={yt_q}"))
+        rows.append(row)
+    return InlineKeyboardMarkup(rows)
+
+# ========= Media job scheduler (yt-dlp / FFmpeg off the event loop) =========
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(os.cpu_count() or 2)))
+MEDIA_QUEUE_MAX = int(os.getenv("MEDIA_QUEUE_MAX", "20"))   # waiting jobs before new ones are refused
+MEDIA_POSITION_INTERVAL = float(os.getenv("MEDIA_POSITION_INTERVAL", "2"))   # min seconds between queue-position edits
+PRIORITY_ADMIN, PRIORITY_SEARCH, PRIORITY_USER, PRIORITY_PREFETCH = 0, 5, 10, 20
+
+class QueueFull(Exception):
+    pass
+
+class MediaJob:
+    def __init__(self, priority: int, seq: int, fn: Callable, args: tuple, label: str,
+                 on_position: Optional[Callable[[int], Awaitable[None]]],
+                 on_finish: Optional[Callable[[], None]] = None):
+        # on_position(n) is awaited when the job moves to place n in line, and with 0 once it starts.
+        # on_finish() is called once the job is really over: ran to the end, failed, or was dropped
+        # from the queue. Cancelling the future doesn't stop a job that is already in the pool.
+        self.priority, self.seq, self.fn, self.args, self.label = priority, seq, fn, args, label
+        self.on_position, self.on_finish = on_position, on_finish
+        self.position = 0
+        self.notified = False
+        self.telling = False   # an on_position update is being sent; it picks up newer positions itself
+        self.told: Optional[int] = None
+        self.told_at = float("-inf")
+        self.started = asyncio.Event()
+        self.queued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "MediaJob"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def finish(self):
+        if self.on_finish:
+            try:
+                self.on_finish()
+            except Exception:
+                log.exception("on_finish of media job %s failed", self.label)
+
+class MediaScheduler:
+    """Priority queue of media jobs served by a process pool sized to the CPU count.
+    submit() refuses work once max_queue jobs are waiting, reports queue positions through
+    an optional callback, and keeps per-stage timings (queue, download, transcode, upload)."""
+
+    def __init__(self, workers: int, max_queue: int, name: str = "media"):
+        self.workers, self.max_queue, self.name = workers, max_queue, name
+        self._heap: List[MediaJob] = []
+        self._seq = itertools.count()
+        self._items: Optional[asyncio.Semaphore] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+        self._callbacks: Set[asyncio.Task] = set()   # on_position tasks, referenced until they finish
+        self.busy = 0
+        self.rejected = 0
+        self.pool_restarts = 0
+        self.timings: Dict[str, List[float]] = {}   # stage -> [count, total, max]
+        self.bytes: Dict[str, int] = {}              # stage -> bytes moved (download, output, upload)
+
+    def start(self):
+        self._items = asyncio.Semaphore(0)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks + list(self._callbacks):
+            t.cancel()
+        for job in self._heap:
+            job.future.cancel()
+            job.finish()
+        self._heap.clear()
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def depth(self) -> int:
+        return len(self._heap)
+
+    def _replace_pool(self, broken: ProcessPoolExecutor):
+        """A worker process died (OOM kill, crash) and took the pool with it: start a fresh one.
+        Jobs that were running on the broken pool fail; queued ones run on the new pool."""
+        if self._pool is not broken:
+            return   # another job on the same pool already replaced it
+        log.error("Media process pool broke, starting a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.pool_restarts += 1
+
+    def record_bytes(self, stage: str, n: int):
+        METRICS.inc("bot_media_bytes_total", n, pool=self.name, stage=stage)
+        self.bytes[stage] = self.bytes.get(stage, 0) + n
+
+    def record(self, stage: str, seconds: float):
+        METRICS.observe("bot_media_stage_seconds", seconds, pool=self.name, stage=stage)
+        t = self.timings.setdefault(stage, [0, 0.0, 0.0])
+        t[0] += 1; t[1] += seconds; t[2] = max(t[2], seconds)
+
+    async def submit(self, fn: Callable, *args, priority: int = PRIORITY_USER, label: str = "",
+                     on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+                     on_finish: Optional[Callable[[], None]] = None):
+        """Runs fn(*args) in the process pool and returns its result. Raises QueueFull."""
+        if self._items is None:
+            self.start()
+        if len(self._heap) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(label)
+        job = MediaJob(priority, next(self._seq), fn, args, label, on_position, on_finish)
+        heapq.heappush(self._heap, job)
+        self._items.release()
+        self._notify_positions()
+        return await job.future
+
+    def _tell(self, job: MediaJob, pos: int):
+        job.position = pos
+        if not job.telling:
+            job.telling = True
+            task = asyncio.create_task(self._tell_latest(job))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
+
+    @staticmethod
+    async def _tell_latest(job: MediaJob):
+        # Each pop moves everyone behind it up one place; sending only the newest position, at most
+        # every MEDIA_POSITION_INTERVAL, keeps a long queue from turning into a flood of message edits.
+        try:
+            while job.told != job.position:
+                wait = job.told_at + MEDIA_POSITION_INTERVAL - time.monotonic()
+                if wait > 0 and job.position:   # "started" (0) goes out right away, even mid-wait
+                    try:
+                        await asyncio.wait_for(job.started.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    if job.future.done():
+                        break   # finished meanwhile; the caller has moved on to its own status edits
+                job.told, job.told_at = job.position, time.monotonic()
+                await job.on_position(job.told)
+        finally:
+            job.telling = False
+
+    def _notify_positions(self):
+        # Only the waiting jobs whose place in line actually changed get a (message-editing) callback.
+        # While a worker is free the job is about to start, so it isn't told a position at all; a job
+        # that was told one keeps getting updates.
+        for pos, job in enumerate(sorted(self._heap), 1):
+            if job.position != pos and job.on_position and (job.notified or self.busy >= self.workers):
+                job.notified = True
+                self._tell(job, pos)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._items.acquire()
+            job = heapq.heappop(self._heap)
+            if job.future.cancelled():
+                job.finish()
+                self._notify_positions()
+                continue
+            job.started.set()
+            if job.notified:
+                self._tell(job, 0)
+            self.record("queue", time.monotonic() - job.queued_at)
+            self.busy += 1
+            self._notify_positions()   # after busy is counted, so the jobs behind this one hear they moved up
+            pool = self._pool
+            try:
+                result = await loop.run_in_executor(pool, job.fn, *job.args)
+                if isinstance(result, dict):
+                    for stage, secs in result.get("timings", {}).items():
+                        self.record(stage, secs)
+                    for stage, n in result.get("bytes", {}).items():
+                        self.record_bytes(stage, n)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except BrokenProcessPool as e:
+                self._replace_pool(pool)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.busy -= 1
+                job.finish()
+
+    def stats_line(self) -> str:
+        parts = [f"{st} {tot / n:.1f}s avg/{mx:.1f}s max" for st, (n, tot, mx) in sorted(self.timings.items()) if n]
+        moved = [f"{st} {n / 1048576:.1f} MB" for st, n in sorted(self.bytes.items())]
+        return (f"{self.name}: {self.busy}/{self.workers} busy, {self.depth()}/{self.max_queue} queued, "
+                f"{self.rejected} rejected" + (f", {self.pool_restarts} pool restarts" if self.pool_restarts else "")
+                + ("; " + ", ".join(parts) if parts else "")
+                + ("; " + ", ".join(moved) if moved else ""))
+
+MEDIA = MediaScheduler(MEDIA_WORKERS, MEDIA_QUEUE_MAX)
+# yt-dlp fallback searches get their own small pool: priority only reorders waiting jobs, so in
+# MEDIA a search would still sit behind every download already running. Forked on first use.
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "1"))
+SEARCH_QUEUE_MAX = int(os.getenv("SEARCH_QUEUE_MAX", "20"))
+SEARCH_POOL = MediaScheduler(SEARCH_WORKERS, SEARCH_QUEUE_MAX, name="search")
+MEDIA_TMP_DIR = os.getenv("MEDIA_TMP_DIR") or None   # None = system temp dir
+TO_M4A_MODE = os.getenv("TO_M4A_MODE", "stream")   # "stream" (FFmpeg, constant memory) | "pydub" (decode in RAM)
+MEDIA_BUSY_TEXT = "🚦 السيرفر مشغول دلوقتي بطلبات كتير. جرّب تاني بعد دقيقة."
+
+async def edit_status(msg, text: str):
+    """Best-effort edit of a progress message (missing message / 'not modified' are ignored)."""
+    if msg is None or not hasattr(msg, "edit_text"):
+        return
+    try:
+        await msg.edit_text(text)
+    except Exception as e:
+        log.debug("Status edit failed: %s", e)
+
+def queue_position_updater(msg) -> Callable[[int], Awaitable[None]]:
+    async def _update(pos: int):
+        await edit_status(msg, f"⏳ في الطابور... دورك رقم {pos}" if pos else "⏳ بدأنا الشغل على طلبك...")
+    return _update
+
+def warmup_job() -> Dict[str, Any]:
+    """No-op pool job: the first submit forks the workers, after warm_up() has imported yt_dlp."""
+    return {"pid": os.getpid()}
+
+TG_UPLOAD_LIMIT = int(float(os.getenv("TG_UPLOAD_LIMIT_MB", "50")) * 1024 * 1024)   # 2000 on a self-hosted Bot API
+AUDIO_BITRATES = (192, 160, 128, 96, 64)   # kbps ladder for re-encodes, best first
+AUDIO_SPLIT_BITRATE = 96                  # when no rung fits, keep this quality and split instead
+SIZE_HEADROOM = 0.95                      # container overhead + VBR wobble
+
+def yt_audio_opts(out_dir: Path) -> Dict[str, Any]:
+    """yt-dlp options for the YT_AUDIO_FORMAT artifact: the audio-only stream as served, native
+    AAC/m4a first so ytdlp_job can usually remux instead of re-encoding. Written into out_dir."""
+    return {
+        'format': 'bestaudio[acodec^=mp4a]/bestaudio[ext=m4a]/bestaudio/best',
+        'outtmpl': str(out_dir / "%(id)s.src.%(ext)s"),
+        'noplaylist': True,
+        'quiet': True,
+    }
 
+def pick_bitrate(duration: float, max_bytes: int) -> Optional[int]:
+    """Highest ladder bitrate (kbps) at which `duration` seconds fit in max_bytes; None if none does."""
+    if not duration:
+        return AUDIO_BITRATES[0]
+    budget = max_bytes * 8 * SIZE_HEADROOM / duration / 1000
+    return next((b for b in AUDIO_BITRATES if b <= budget), None)
+
+def plan_parts(duration: float, chapters: Optional[List[Dict[str, Any]]], max_seconds: float) -> List[Tuple[float, float, str]]:
+    """(start, end, chapter title) cuts no longer than max_seconds. Each part takes as many whole
+    chapters as fit; without usable chapters the rest is cut into equal slices."""
+    marks = sorted((float(c.get("start_time") or 0), c.get("title") or "") for c in chapters or [])
+    bounds = [t for t, _ in marks if 0 < t < duration]
+
+    def chapter_at(t: float) -> str:
+        return next((title for start, title in reversed(marks) if start <= t), "")
+
+    parts, start = [], 0.0
+    while duration - start > max_seconds:
+        fits = [t for t in bounds if start < t <= start + max_seconds]
+        if fits and fits[-1] - start >= max_seconds / 3:   # don't trade an even split for a sliver
+            end = fits[-1]
+        else:
+            end = start + (duration - start) / math.ceil((duration - start) / max_seconds)
+        parts.append((start, end, chapter_at(start)))
+        start = end
+    parts.append((start, duration, chapter_at(start)))
+    return parts
+
+def run_ffmpeg(*args: Any):
+    res = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y", *map(str, args)],
+                         capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {res.stderr.strip()[-500:]}")
+
+def ytdlp_job(youtube_url: str, ydl_opts: Dict[str, Any], max_bytes: int = TG_UPLOAD_LIMIT) -> Dict[str, Any]:
+    """Process-pool job: download the audio stream, remux AAC as-is (or re-encode at the best
+    bitrate that fits max_bytes), then split at chapter boundaries if it still doesn't fit.
+    Returns the parts plus per-stage timings and byte counts."""
+    marks = {"start": time.monotonic()}
+
+    def _progress(d):
+        if d.get("status") == "finished":
+            marks.setdefault("downloaded", time.monotonic())
+
+    opts = dict(ydl_opts, progress_hooks=[_progress])
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(youtube_url, download=True)
+        src = Path(ydl.prepare_filename(info))
+    downloaded = time.monotonic()
+    marks.setdefault("downloaded", downloaded)
+    title = info.get('title') or 'Audio'
+    artist = info.get('artist') or info.get('creator') or info.get('uploader') or ''
+    duration = float(info.get('duration') or 0)
+    src_bytes = src.stat().st_size
+
+    out = src.with_name(f"{info.get('id') or 'audio'}.m4a")
+    bitrate = pick_bitrate(duration, max_bytes)
+    abr = float(info.get('abr') or 0)
+    remux = probe_audio_codec(str(src)) == "aac" and (
+        src_bytes <= max_bytes * SIZE_HEADROOM or (abr and abr <= (bitrate or AUDIO_SPLIT_BITRATE)))
+    codec = ["-c:a", "copy"] if remux else ["-c:a", "aac", "-b:a", f"{bitrate or AUDIO_SPLIT_BITRATE}k", "-ar", "44100"]
+    run_ffmpeg("-i", src, "-map", "0:a:0", "-vn", *codec, "-metadata", f"title={title}",
+               "-metadata", f"artist={artist}", "-movflags", "+faststart", out)
+    src.unlink(missing_ok=True)
+    converted = time.monotonic()
+
+    out_bytes = out.stat().st_size
+    parts = [{"path": str(out), "title": title, "bytes": out_bytes}]
+    if out_bytes > max_bytes and duration:
+        plan = plan_parts(duration, info.get('chapters'), duration * max_bytes * SIZE_HEADROOM / out_bytes)
+        parts = []
+        for i, (a, b, chapter) in enumerate(plan, 1):
+            part = out.with_name(f"{out.stem}.part{i}.m4a")
+            run_ffmpeg("-ss", f"{a:.3f}", "-to", f"{b:.3f}", "-i", out, "-map", "0:a:0", "-c", "copy",
+                       "-metadata", f"title={title} ({i}/{len(plan)})", "-movflags", "+faststart", part)
+            parts.append({"path": str(part), "title": f"{title} ({i}/{len(plan)})" + (f" — {chapter}" if chapter else ""),
+                          "bytes": part.stat().st_size})
+        out.unlink(missing_ok=True)
+    end = time.monotonic()
+
+    timings = {"download": marks["downloaded"] - marks["start"], "transcode": converted - downloaded}
+    if len(parts) > 1:
+        timings["split"] = end - converted
+    return {
+        "path": parts[0]["path"],
+        "parts": parts,
+        "title": title,
+        "artist": artist,
+        "duration": duration,
+        "mode": "remux" if remux else f"aac {bitrate or AUDIO_SPLIT_BITRATE}k",
+        "timings": timings,
+        "bytes": {"download": src_bytes, "output": sum(p["bytes"] for p in parts)},
+    }
+
+def probe_audio_codec(path: str) -> str:
+    """Codec name of the first audio stream ("" if ffprobe can't tell)."""
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name",
+             "-of", "default=nw=1:nk=1", path],
+            capture_output=True, text=True, timeout=60,
+        )
+        return out.stdout.strip().lower()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+def ffmpeg_m4a_job(in_path: str, out_path: str, bitrate: str = "192k") -> Dict[str, Any]:
+    """Process-pool job: streams the first audio track into an m4a container with FFmpeg,
+    so memory stays flat regardless of input size. AAC input is stream-copied, not re-encoded."""
+    start = time.monotonic()
+    copy = probe_audio_codec(in_path) == "aac"
+    codec = ["-c:a", "copy"] if copy else ["-c:a", "aac", "-b:a", bitrate]
+    run_ffmpeg("-i", in_path, "-map", "0:a:0", "-vn", *codec, "-movflags", "+faststart", out_path)
+    return {"path": out_path, "copied": copy, "timings": {"transcode": time.monotonic() - start}}
+
+def pydub_m4a_job(in_path: str, out_path: str) -> Dict[str, Any]:
+    start = time.monotonic()
+    audio = pydub.AudioSegment.from_file(in_path)
+    audio.export(out_path, format="mp4")  # m4a container (AAC)
+    return {"path": out_path, "timings": {"transcode": time.monotonic() - start}}
 
-def kb_for_track(t: Dict[str, Any]) -> InlineKeyboardMarkup:
-    tid = t["trackId"]
-    song = t.get("trackName", ""); artist = t.get("artistName","")
-    yt_q = urllib.parse.quote(f"{song} {artist}".strip())
-    btns = [
-        [InlineKeyboardButton("▶️ Listen now", callback_data=f"play|{tid}")],
-        [InlineKeyboardButton("🔗 Open on Apple", url=t.get("trackViewUrl",""))],
-        [InlineKeyboardButton("▶️ YouTube for this", url=f"https://www.youtube.com/results?q={yt_q}")]
-    ]
-    return InlineKeyboardMarkup(btns)
 
 # ========= File → m4a (uploads only) =========
-from pydub import AudioSegment
 async def to_m4a_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     touch_user(update)
     if ADMIN_ID and (not update.effective_user or update.effective_user.id != ADMIN_ID):
@@ -278,6 +1735,7 @@ async def to_m4a_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("ابعت ملف صوت/فيديو تملكه، وأنا هرجّعه لك m4a. لازم FFmpeg يكون متثبت.")
 
+@instrumented("to_m4a_receive")
 async def to_m4a_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     touch_user(update)
     if ADMIN_ID and (not update.effective_user or update.effective_user.id != ADMIN_ID):
@@ -288,101 +1746,504 @@ async def to_m4a_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("من فضلك ابعت ملف صوت/فيديو أو استخدم /to_m4a الأول.")
         return
     tf = await file_obj.get_file()
-    in_path  = Path(f"in_{tf.file_unique_id}")
-    out_path = Path(f"out_{tf.file_unique_id}.m4a")
-    await tf.download_to_drive(in_path)
+    with tempfile.TemporaryDirectory(prefix="to_m4a_", dir=MEDIA_TMP_DIR) as temp_dir:
+        in_path  = Path(temp_dir) / f"in_{tf.file_unique_id}"
+        out_path = Path(temp_dir) / f"out_{tf.file_unique_id}.m4a"
+        t0 = time.monotonic()
+        await tf.download_to_drive(in_path)
+        MEDIA.record("download", time.monotonic() - t0)
+        status = await update.message.reply_text("⏳ بحوّل الملف...")
+        job = ffmpeg_m4a_job if TO_M4A_MODE == "stream" else pydub_m4a_job
+        try:
+            res = await MEDIA.submit(job, str(in_path), str(out_path), priority=PRIORITY_ADMIN,
+                                     label="to_m4a", on_position=queue_position_updater(status))
+            t0 = time.monotonic()
+            with out_path.open("rb") as f:
+                await update.message.reply_audio(audio=f, caption="اتفضل .m4a ✅")
+            MEDIA.record("upload", time.monotonic() - t0)
+            await edit_status(status, "✅ تم التحويل" + (" (من غير إعادة ترميز)." if res.get("copied") else "."))
+        except QueueFull:
+            await edit_status(status, MEDIA_BUSY_TEXT)
+        except Exception as e:
+            await update.message.reply_text(f"فشل التحويل: {e}\nتأكد إن FFmpeg على PATH.")
+
+# ========= Audio artifact cache (video ID -> Telegram file_id / local m4a) =========
+AUDIO_FILE_CACHE_DIR = os.getenv("AUDIO_FILE_CACHE_DIR", "")     # empty = no local file tier
+AUDIO_FILE_CACHE_MB = int(os.getenv("AUDIO_FILE_CACHE_MB", "2048"))
+YT_AUDIO_FORMAT = "m4a-fit"    # bump when the yt-dlp/FFmpeg output settings change
+
+class AudioCache:
+    """Remembers the Telegram file_id of every audio we uploaded, keyed by (video_id, format),
+    so repeat requests are a single send_audio(file_id). Entries live in the state backend's
+    "audio" namespace. Optionally keeps the m4a files on disk too, evicting least-recently-used
+    files once the directory grows past max_bytes."""
+
+    NS = "audio"
+
+    def __init__(self, backend: StateBackend, file_dir: str = "", max_bytes: int = 0):
+        self.backend = backend
+        self.file_dir = Path(file_dir) if file_dir else None
+        self.max_bytes = max_bytes
+        if self.file_dir:
+            self.file_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = self.file_hits = self.misses = 0
+        self._local = TTLCache(f"{self.NS}-local", 20_000, STATE_LOCAL_TTL)   # keeps lookups off the backend
+
+    def get(self, video_id: str, fmt: str) -> Optional[Dict[str, str]]:
+        """Cached metadata; file_id is "" when Telegram rejected the old one."""
+        key = f"{video_id}|{fmt}"
+        hit = self._local.get(key, _ABSENT)
+        if hit is _ABSENT:
+            hit = self.backend.get(self.NS, key)
+            self._local.set(key, hit)
+        return hit
+
+    def _set(self, key: str, entry: Dict[str, Any]):
+        self.backend.set(self.NS, key, entry)
+        self._local.set(key, entry)
+
+    def put(self, video_id: str, fmt: str, file_id: str, title: str, performer: str,
+            parts: Optional[List[Dict[str, str]]] = None):
+        """`parts` ([{"file_id", "title"}, ...]) is set when the audio was too big for one upload."""
+        entry = {"file_id": file_id, "title": title, "performer": performer}
+        if parts:
+            entry["parts"] = parts
+        self._set(f"{video_id}|{fmt}", entry)
+
+    def forget(self, video_id: str, fmt: str):
+        hit = self.get(video_id, fmt)
+        if hit:
+            self._set(f"{video_id}|{fmt}", dict(hit, file_id=""))
+
+    def _file(self, video_id: str, fmt: str) -> Optional[Path]:
+        return self.file_dir / f"{video_id}.{fmt}.m4a" if self.file_dir else None
+
+    def local_file(self, video_id: str, fmt: str) -> Optional[Path]:
+        path = self._file(video_id, fmt)
+        if path and path.exists():
+            os.utime(path)   # LRU order is by mtime
+            return path
+        return None
+
+    def store_file(self, video_id: str, fmt: str, src: Path):
+        dst = self._file(video_id, fmt)
+        if not dst:
+            return
+        try:
+            shutil.copyfile(src, dst)
+            self._evict()
+        except OSError as e:
+            log.warning("Audio file cache write failed: %s", e)
+
+    def _evict(self):
+        files = sorted(self.file_dir.glob("*.m4a"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        while files and total > self.max_bytes:
+            f = files.pop(0)
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+
+    def stats_line(self) -> str:
+        total = self.backend.count(self.NS)
+        n = self.backend.count_with(self.NS, "file_id")   # forget() leaves entries with file_id ""
+        return f"audio: {n} cached ({total - n} forgotten), {self.hits} file_id hits / {self.file_hits} disk hits / {self.misses} misses"
+
+AUDIO_CACHE: Optional[AudioCache] = None
+
+def load_audio_cache():
+    global AUDIO_CACHE
+    AUDIO_CACHE = AudioCache(state(), AUDIO_FILE_CACHE_DIR, AUDIO_FILE_CACHE_MB * 1024 * 1024)
+
+async def send_cached_audio(msg: Message, video_id: str) -> bool:
+    """Re-sends a previously uploaded audio by file_id. False if there is nothing (valid) cached."""
+    if AUDIO_CACHE is None:
+        return False
+    hit = AUDIO_CACHE.get(video_id, YT_AUDIO_FORMAT)
+    if not hit or not hit["file_id"]:
+        return False
     try:
-        audio = AudioSegment.from_file(in_path)
-        audio.export(out_path, format="mp4")  # m4a container (AAC)
-        await update.message.reply_audio(audio=out_path.open("rb"), caption="اتفضل .m4a ✅")
-    except Exception as e:
-        await update.message.reply_text(f"فشل التحويل: {e}\nتأكد إن FFmpeg على PATH.")
-    finally:
-        try: in_path.unlink(missing_ok=True)
-        except: pass
-        try: out_path.unlink(missing_ok=True)
-        except: pass
+        for part in hit.get("parts") or [{"file_id": hit["file_id"], "title": hit["title"]}]:
+            await msg.reply_audio(
+                audio=part["file_id"], caption=f"✅ {part['title']}", title=part["title"], performer=hit["performer"]
+            )
+    except BadRequest as e:   # file_id no longer valid for this bot
+        log.info("Cached file_id for %s rejected (%s), re-downloading", video_id, e)
+        AUDIO_CACHE.forget(video_id, YT_AUDIO_FORMAT)
+        return False
+    AUDIO_CACHE.hits += 1
+    return True
+
+# ========= Speculative prefetch (top YouTube results, before the click) =========
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "0"))              # 0 = off
+PREFETCH_MAX_ACTIVE = int(os.getenv("PREFETCH_MAX_ACTIVE", "1"))    # prefetch jobs queued/running at once
+PREFETCH_MB = int(os.getenv("PREFETCH_MB", "512"))                  # disk cap for unclaimed prefetches
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "600"))              # seconds an unclaimed prefetch is kept
+PREFETCH_DIR = os.getenv("PREFETCH_DIR") or os.path.join(tempfile.gettempdir(), "bot_prefetch")
+
+class PrefetchEntry:
+    def __init__(self, video_id: str, path: Path):
+        self.video_id, self.path = video_id, path
+        self.task: Optional[asyncio.Task] = None
+        self.running = False      # a pool job is queued/running (it outlives a cancelled task)
+        self.abandoned = False    # nobody wants the files any more: delete them when the job ends
+        self.created = time.monotonic()
+
+class Prefetcher:
+    """Starts downloading the top search results at the lowest media priority, only while the
+    pool has idle workers, so "Listen now" on one of them is usually just an upload.
+    Unclaimed prefetches are cancelled (if still queued) and deleted after `ttl`, or earlier
+    when the directory passes `max_bytes`; a job already in the pool can't be stopped, so its
+    files are deleted when it finishes. Hit/waste counters are in stats_line()."""
+
+    def __init__(self, root: str, top_k: int, max_active: int, max_bytes: int, ttl: float):
+        self.root, self.top_k, self.max_active, self.max_bytes, self.ttl = Path(root), top_k, max_active, max_bytes, ttl
+        self._entries: "OrderedDict[str, PrefetchEntry]" = OrderedDict()
+        self._draining: Set[PrefetchEntry] = set()   # abandoned, pool job still writing files
+        self.started = self.skipped = self.hits_ready = self.hits_waiting = self.misses = self.wasted = 0
+        self.wasted_seconds = self.saved_seconds = 0.0
+
+    def _active(self) -> int:
+        return sum(1 for e in self._entries.values() if not e.task.done())
+
+    def _disk_bytes(self) -> int:
+        return sum(f.stat().st_size for f in self.root.rglob("*") if f.is_file()) if self.root.exists() else 0
+
+    @staticmethod
+    def _job_seconds(entry: PrefetchEntry) -> float:
+        if entry.task.done() and not entry.task.cancelled() and not entry.task.exception():
+            return sum(entry.task.result().get("timings", {}).values())
+        return 0.0
+
+    def _abandon(self, entry: PrefetchEntry):
+        if not entry.task.done():
+            entry.task.cancel()   # still queued: never runs; already running: the result is thrown away
+        entry.abandoned = True
+        if entry.running:
+            self._draining.add(entry)   # _job_finished() deletes the files
+        else:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _job_finished(self, entry: PrefetchEntry):
+        entry.running = False
+        if entry.abandoned:
+            self._draining.discard(entry)
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _drop(self, video_id: str):
+        entry = self._entries.pop(video_id)
+        self.wasted += 1
+        self.wasted_seconds += self._job_seconds(entry)
+        self._abandon(entry)
+
+    def sweep(self):
+        now = time.monotonic()
+        for vid in [v for v, e in self._entries.items() if now - e.created > self.ttl]:
+            self._drop(vid)
+
+    def schedule(self, results: List[Dict[str, str]]):
+        """Called with freshly shown results; starts up to top_k prefetches within the budget."""
+        if not self.top_k:
+            return
+        self.sweep()
+        for r in results[:self.top_k]:
+            vid = youtube_video_id(r["url"])
+            if not vid or vid in self._entries or FLIGHTS.in_flight(f"yt_dl|{vid}"):
+                continue
+            if AUDIO_CACHE is not None and ((AUDIO_CACHE.get(vid, YT_AUDIO_FORMAT) or {}).get("file_id")
+                                            or AUDIO_CACHE.local_file(vid, YT_AUDIO_FORMAT)):
+                continue   # already a file_id or local file away
+            if self._active() >= self.max_active or MEDIA.depth() or MEDIA.busy >= MEDIA.workers:
+                self.skipped += 1
+                return
+            # The cap is on what is really on disk, including jobs that are still draining.
+            used = self._disk_bytes()
+            while self._entries and used >= self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                used = self._disk_bytes()
+            if used >= self.max_bytes:
+                self.skipped += 1
+                return
+            self.root.mkdir(parents=True, exist_ok=True)
+            entry = PrefetchEntry(vid, Path(tempfile.mkdtemp(prefix=f"{vid}.", dir=self.root)))
+            entry.task = asyncio.create_task(self._fetch(r["url"], entry))
+            self._entries[vid] = entry
+            self.started += 1
+
+    async def _fetch(self, url: str, entry: PrefetchEntry) -> Dict[str, Any]:
+        entry.running = True   # submit() queues the job before its first await
+        try:
+            return await MEDIA.submit(ytdlp_job, url, yt_audio_opts(entry.path), priority=PRIORITY_PREFETCH,
+                                      label=f"prefetch|{entry.video_id}", on_finish=lambda: self._job_finished(entry))
+        except QueueFull:
+            entry.running = False
+            raise
+
+    def take(self, video_id: str) -> Optional[PrefetchEntry]:
+        """Hands the prefetch for video_id (finished or still running) to the downloader."""
+        if not self.top_k:
+            return None
+        entry = self._entries.pop(video_id, None)
+        if entry is None or (entry.task.done() and (entry.task.cancelled() or entry.task.exception())):
+            self.misses += 1
+            return None
+        if entry.task.done():
+            self.hits_ready += 1
+            self.saved_seconds += self._job_seconds(entry)
+        else:
+            self.hits_waiting += 1
+        return entry
+
+    @contextmanager
+    def claimed(self, entry: Optional[PrefetchEntry]):
+        """Deletes a taken prefetch's files once the caller is done with them."""
+        try:
+            yield entry
+        finally:
+            if entry:
+                self._abandon(entry)
+
+    async def run_sweeper(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def stop(self):
+        for vid in list(self._entries):
+            self._drop(vid)
+        for entry in list(self._draining):   # the pool is going away with them
+            shutil.rmtree(entry.path, ignore_errors=True)
+        self._draining.clear()
+
+    def stats_line(self) -> str:
+        hits = self.hits_ready + self.hits_waiting
+        clicks = hits + self.misses
+        rate = f"{hits / self.started:.0%}" if self.started else "n/a"
+        return (f"prefetch: {self.started} started, {hits} used ({self.hits_ready} ready / {self.hits_waiting} waited), "
+                f"hit rate {rate}, {hits}/{clicks} clicks covered, {self.wasted} wasted "
+                f"({self.wasted_seconds:.0f}s media time, {self.saved_seconds:.0f}s saved), "
+                f"{self.skipped} skipped for load, {len(self._entries)} pending, {len(self._draining)} draining")
+
+PREFETCH = Prefetcher(PREFETCH_DIR, PREFETCH_TOP_K, PREFETCH_MAX_ACTIVE, PREFETCH_MB * 1024 * 1024, PREFETCH_TTL)
 
 # --- Download & convert YouTube audio (keeps original title & sets proper metadata) ---
-async def download_and_convert_yt(update: Update, context: ContextTypes.DEFAULT_TYPE, youtube_url: str):
+@instrumented("download_and_convert_yt")
+async def download_and_convert_yt(msg: Message, youtube_url: str):
     """Downloads audio from a YouTube URL and sends it back as M4A, keeping the original title
     (caption + Telegram filename) while staying cookie-free.
+    Concurrent requests for the same video share one download; the others get its file_id.
     """
-    await update.message.reply_text("⏳ ببدأ التحميل والتحويل...")
+    video_id = youtube_video_id(youtube_url)
+    if video_id and await send_cached_audio(msg, video_id):
+        return
+
+    try:
+        if not video_id:
+            await _download_and_send(msg, youtube_url, None)
+            return
+        key = f"yt_dl|{video_id}"
+        if FLIGHTS.in_flight(key):
+            await msg.reply_text("⏳ الأغنية دي بتتحمّل دلوقتي، ثواني وتوصلك...")
+        while True:
+            sent, shared = await FLIGHTS.do(key, lambda: _download_and_send(msg, youtube_url, video_id))
+            if not shared:
+                return
+            if not sent:   # the leader was turned away (queue full); its followers would be too
+                await msg.reply_text(MEDIA_BUSY_TEXT)
+                return
+            if await send_cached_audio(msg, video_id):
+                return
+            # The leader's upload isn't reusable (cache off, file_id rejected): the next round elects
+            # one of the remaining followers as leader and the rest join it, instead of all re-running.
+    except Exception as e:
+        log.exception("Error downloading/converting YouTube video:")
+        error_msg = f"❌ حدث خطأ أثناء التحميل أو التحويل:\n{e}"
+        if "No Media found" in str(e) or "Unsupported URL" in str(e):
+            error_msg += "\nقد يكون الرابط غير مدعوم أو لا يحتوي على صوت."
+        elif "ffmpeg" in str(e).lower():
+            error_msg += "\nتأكد من تثبيت FFmpeg ووجوده في PATH."
+        await msg.reply_text(error_msg)
+
 
+async def _download_and_send(msg: Message, youtube_url: str, video_id: Optional[str]):
     def _safe_filename(name: str) -> str:
         name = name.replace("/", "-").replace("\\", "-")
         name = re.sub(r"[\n\r\t]", " ", name)
         name = re.sub(r"[:*?\"<>|]", "", name).strip()
         return name or "audio"
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir)
-        outtmpl = temp_path / "%(title)s.%(ext)s"
-
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': str(outtmpl),
-            'noplaylist': True,
-            'postprocessors': [
-                {'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a', 'preferredquality': '192'},
-                {'key': 'FFmpegMetadata', 'add_metadata': True},
-            ],
-            'postprocessor_args': ['-ar', '44100'],
-            'prefer_ffmpeg': True,
-            'keepvideo': False,
-            'quiet': True,
-        }
-
+    async def _upload(path: Path, title: str, artist: str) -> str:
+        with path.open('rb') as f:
+            sent = await msg.reply_audio(
+                audio=InputFile(f, filename=f"{_safe_filename(title)}.m4a"),
+                caption=f"✅ {title}",
+                title=title,
+                performer=artist
+            )
+        MEDIA.record_bytes("upload", path.stat().st_size)
+        return sent.audio.file_id if getattr(sent, "audio", None) else ""
+
+    async def _remember(title: str, artist: str, sent: List[Dict[str, str]]):
+        if video_id and AUDIO_CACHE is not None and all(p["file_id"] for p in sent):
+            # On the loop: put() updates the local LRU that get() reorders; the backend write is buffered.
+            AUDIO_CACHE.put(video_id, YT_AUDIO_FORMAT, sent[0]["file_id"], title, artist, sent if len(sent) > 1 else None)
+
+    meta = AUDIO_CACHE.get(video_id, YT_AUDIO_FORMAT) if video_id and AUDIO_CACHE is not None else None
+    local = AUDIO_CACHE.local_file(video_id, YT_AUDIO_FORMAT) if meta else None
+    if local:
+        AUDIO_CACHE.file_hits += 1
         try:
-            def run_ytdlp():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(youtube_url, download=True)
-                    base = ydl.prepare_filename(info)
-                    m4a_path = Path(base).with_suffix('.m4a')
-                    title = info.get('title') or 'Audio'
-                    artist = info.get('artist') or info.get('creator') or info.get('uploader') or ''
-                    return m4a_path, title, artist
-
-            loop = asyncio.get_event_loop()
-            final_path, meta_title, meta_artist = await loop.run_in_executor(None, run_ytdlp)
-
-            with final_path.open('rb') as f:
-                await update.message.reply_audio(
-                    audio=InputFile(f, filename=f"{_safe_filename(meta_title)}.m4a"),
-                    caption=f"✅ {meta_title}",
-                    title=meta_title,
-                    performer=meta_artist
-                )
-            await update.message.reply_text("✅ تم التحميل والإرسال بالاسم .")
-        except Exception as e:
-            log.exception("Error downloading/converting YouTube video:")
-            error_msg = f"❌ حدث خطأ أثناء التحميل أو التحويل:\n{e}"
-            if "No Media found" in str(e) or "Unsupported URL" in str(e):
-                error_msg += "\nقد يكون الرابط غير مدعوم أو لا يحتوي على صوت."
-            elif "ffmpeg" in str(e).lower():
-                error_msg += "\nتأكد من تثبيت FFmpeg ووجوده في PATH."
-            await update.message.reply_text(error_msg)
+            title = meta["title"] or "Audio"
+            file_id = await _upload(local, title, meta["performer"])
+            await _remember(title, meta["performer"], [{"file_id": file_id, "title": title}])
+            return True
+        except Exception:
+            log.exception("Sending cached audio file failed, re-downloading")
+    if AUDIO_CACHE is not None:
+        AUDIO_CACHE.misses += 1
 
-# ========= Gemini AI (friendlier replies, no markdown) =========
+    pre = PREFETCH.take(video_id) if video_id else None
+    status = await msg.reply_text("⏳ ببدأ التحميل والتحويل...")
 
-def ai_chat_reply(prompt: str) -> str:
+    with tempfile.TemporaryDirectory() as temp_dir, PREFETCH.claimed(pre):
+        temp_path = Path(temp_dir)
+        res = None
+        if pre:
+            try:
+                res = await pre.task
+            except Exception as e:
+                log.info("Prefetch of %s failed (%s), downloading again", video_id, e)
+        if res is None:
+            try:
+                res = await MEDIA.submit(ytdlp_job, youtube_url, yt_audio_opts(temp_path), priority=PRIORITY_USER,
+                                         label=f"yt_dl|{video_id or youtube_url}",
+                                         on_position=queue_position_updater(status))
+            except QueueFull:
+                await edit_status(status, MEDIA_BUSY_TEXT)
+                return False
+        meta_title, meta_artist = res["title"], res["artist"]
+        parts = res.get("parts") or [{"path": res["path"], "title": meta_title}]
+        log.info("yt %s: %s, %d part(s), %s", video_id or youtube_url, res.get("mode", "?"), len(parts),
+                 ", ".join(f"{k} {v / 1048576:.1f} MB" for k, v in res.get("bytes", {}).items()))
+        if video_id and AUDIO_CACHE is not None and len(parts) == 1:
+            await asyncio.to_thread(AUDIO_CACHE.store_file, video_id, YT_AUDIO_FORMAT, Path(parts[0]["path"]))
+
+        await edit_status(status, "📤 بيترفع..." if len(parts) == 1 else
+                          f"📤 الملف أكبر من حد تيليجرام، هيوصلك على {len(parts)} أجزاء...")
+        t0 = time.monotonic()
+        sent = [{"file_id": await _upload(Path(p["path"]), p["title"], meta_artist), "title": p["title"]} for p in parts]
+        MEDIA.record("upload", time.monotonic() - t0)
+        await _remember(meta_title, meta_artist, sent)
+        await edit_status(status, "✅ تم التحميل والإرسال بالاسم .")
+        return True
+
+# ========= Gemini AI (friendlier replies, no markdown; streamed) =========
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent"
+AI_HISTORY_TOKENS = int(os.getenv("AI_HISTORY_TOKENS", "3000"))   # context budget sent with each turn
+AI_HISTORY_TURNS = int(os.getenv("AI_HISTORY_TURNS", "20"))       # messages kept per user
+AI_HISTORY_TTL = float(os.getenv("AI_HISTORY_TTL", "3600"))       # conversation forgotten after this idle time
+AI_EDIT_INTERVAL = float(os.getenv("AI_EDIT_INTERVAL", "1.5"))    # min seconds between progressive edits
+AI_USER_CONCURRENCY = int(os.getenv("AI_USER_CONCURRENCY", "1"))
+TG_TEXT_LIMIT = 4096
+AI_NO_KEY_TEXT = "شغّلتني من غير مفتاح AI. لو عاوزني أجاوب أفضل، حط GEMINI_KEY في .env."
+AI_ERROR_TEXT = "حصلت مشكلة بسيطة. جرّب تاني."
+
+AI_HISTORY = TTLCache("ai_history", 10_000, AI_HISTORY_TTL)   # str(user_id) -> [{"role", "text"}, ...]
+_ai_active: Dict[int, int] = {}   # user_id -> AI replies in progress
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1   # rough, but only used to cap the context we resend
+
+def trim_history(turns: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """Newest turns that fit in `budget` tokens (the last one always kept), starting on a user turn."""
+    kept, used = [], 0
+    for turn in reversed(turns):
+        used += estimate_tokens(turn["text"])
+        if used > budget and kept:
+            break
+        kept.append(turn)
+    kept.reverse()
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)
+    return kept
+
+async def ai_chat_stream(uid: int, prompt: str) -> AsyncIterator[str]:
+    """Yields the reply accumulated so far as Gemini streams it; records the turn in history."""
+    history = AI_HISTORY.get(str(uid)) or []
+    turns = trim_history(history + [{"role": "user", "text": prompt}], AI_HISTORY_TOKENS)
+    payload = {"contents": [{"role": t["role"], "parts": [{"text": t["text"]}]} for t in turns]}
+    acc = ""
+    async with http_stream("POST", GEMINI_STREAM_URL, params={"alt": "sse"}, json=payload,
+                           headers={"x-goog-api-key": GEMINI_KEY}, timeout=30) as r:
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = json.loads(line[5:])
+            for cand in chunk.get("candidates", [])[:1]:
+                for part in cand.get("content", {}).get("parts", []):
+                    acc += part.get("text", "")
+            yield acc
+    if acc:
+        history = (history + [{"role": "user", "text": prompt}, {"role": "model", "text": acc}])[-AI_HISTORY_TURNS:]
+        AI_HISTORY.set(str(uid), history)
+
+async def ai_chat_respond(msg: Message, uid: int, prompt: str):
+    """Streams the answer into a single message, edited at most every AI_EDIT_INTERVAL seconds."""
     if not GEMINI_KEY:
-        return "شغّلتني من غير مفتاح AI. لو عاوزني أجاوب أفضل، حط GEMINI_KEY في .env."
+        await msg.reply_text(AI_NO_KEY_TEXT)
+        return
+    active = _ai_active.get(uid, 0)
+    if active >= AI_USER_CONCURRENCY:
+        await msg.reply_text("⏳ استنى لما أخلص الرد اللي فات.")
+        return
+    _ai_active[uid] = active + 1
+    try:
+        await _ai_stream_reply(msg, uid, prompt)
+    finally:
+        if _ai_active[uid] > 1:
+            _ai_active[uid] -= 1
+        else:
+            del _ai_active[uid]   # only users with a reply in progress have an entry
+
+async def _ai_stream_reply(msg: Message, uid: int, prompt: str):
+    await msg.chat.send_action(action="typing")
+    out, shown, last_edit, text = None, "", 0.0, ""
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_KEY}"
-        payload = {"contents": [{"parts": [{"text": prompt}]}]}
-        res = requests.post(url, json=payload, timeout=30)
-        res.raise_for_status()
-        data = res.json()
-        return data["candidates"][0]["content"]["parts"][0]["text"]
-    except Exception:
-        return "حصلت مشكلة بسيطة. جرّب تاني."
+        async for text in ai_chat_stream(uid, prompt):
+            view = text[:TG_TEXT_LIMIT].strip()
+            if not view or view == shown:
+                continue
+            if out is None:
+                out = await msg.reply_text(view)
+            elif time.monotonic() - last_edit >= AI_EDIT_INTERVAL:
+                await out.edit_text(view)
+            else:
+                continue
+            shown, last_edit = view, time.monotonic()
+    except Exception as e:
+        log.warning("Gemini error: %s", e)
+        if not text:
+            await msg.reply_text(AI_ERROR_TEXT)
+            return
+    if not text.strip():
+        await msg.reply_text(AI_ERROR_TEXT)
+        return
+    parts = [text[i:i + TG_TEXT_LIMIT] for i in range(0, len(text), TG_TEXT_LIMIT)]
+    if out is None:
+        await msg.reply_text(parts[0])
+    elif parts[0].strip() != shown:
+        await out.edit_text(parts[0])
+    for extra in parts[1:]:
+        await msg.reply_text(extra)
 
 # ========= Handlers =========
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     touch_user(update)
+    arg = context.args[0] if context.args else ""
+    if arg.startswith("yt_"):   # deep link from an inline result: t.me/<bot>?start=yt_<video id>
+        await download_and_convert_yt(update.message, f"https://www.youtube.com/watch?v={arg[3:]}")
+        return
     await update.message.reply_text(
         "اختار من تحت: أغاني أو AI. تقدر تبدّل المصدر بين YouTube و Apple. "
         "لو عاوز تحوّل ملفك لـ m4a استخدم /to_m4a.",
@@ -407,13 +2268,34 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if ADMIN_ID and update.effective_user and update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("الإحصائيات للمالك فقط.")
         return
-    count = len(USERS)
+    await asyncio.to_thread(save_users)
+    users = await asyncio.to_thread(USER_STORE.load)   # includes users seen by other workers
+    count = len(users)
     lines = [f"👥 Users: {count}"]
-    for uid, info in USERS.items():
+    lines += ["🗃 " + c.stats_line() for c in CACHES]
+    if AUDIO_CACHE is not None:
+        lines.append("🗃 " + await asyncio.to_thread(AUDIO_CACHE.stats_line))
+    lines.append("🔗 " + FLIGHTS.stats_line())
+    lines.append("🎛 " + MEDIA.stats_line())
+    if SEARCH_POOL.timings:
+        lines.append("🎛 " + SEARCH_POOL.stats_line())
+    lines.append("📨 " + TG_LIMITER.stats_line())
+    lines.append("📺 " + YT_QUOTA.stats_line())
+    if PREFETCH.top_k:
+        lines.append("🔮 " + PREFETCH.stats_line())
+    rows = []
+    for uid, info in users.items():
         handle = ("@" + info.get("username","")) if info.get("username") else "(no username)"
         name = " ".join(filter(None, [info.get("first_name",""), info.get("last_name","")])).strip() or "(no name)"
-        lines.append(f"• {uid} — {handle} — {name}")
+        rows.append(f"• {uid} — {handle} — {name}")
+    text = "\n".join(lines + rows)
+    if len(text) <= TG_TEXT_LIMIT:
+        await update.message.reply_text(text)
+        return
+    # Too long for one message: the summary as text, the full list as a file.
     await update.message.reply_text("\n".join(lines))
+    await update.message.reply_document(InputFile("\n".join(rows).encode(), filename="users.txt"),
+                                        caption=f"👥 {count} users")
 
 async def on_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     touch_user(update)
@@ -437,6 +2319,7 @@ async def on_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await handle_query(update, context)
 
+@instrumented("handle_query")
 async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     touch_user(update)
     uid = update.effective_user.id
@@ -445,101 +2328,596 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     mode = user_mode.get(uid)
     if mode == "ai":
-        await update.message.chat.send_action(action="typing")
-        await update.message.reply_text(ai_chat_reply(text))
+        await ai_chat_respond(update.message, uid, text)
         return
+    await run_search(update.message, uid, text)
 
+async def run_search(msg: Message, uid: int, text: str):
+    # One placeholder message per search, edited in place with every result as numbered buttons.
     src = get_pref(uid, "source") or "youtube"
     if src == "youtube":
-        await update.message.reply_text(f"ببحث في YouTube عن: {text}...")
-        results = yt_api_search(text, max_results=12)
+        placeholder = await msg.reply_text(f"ببحث في YouTube عن: {text}...")
+        try:
+            results = (await yt_api_search(text, max_results=12))[:5]
+        except QueueFull:
+            await placeholder.edit_text(MEDIA_BUSY_TEXT)
+            return
         if not results:
             qurl = "https://www.youtube.com/results?q=" + urllib.parse.quote(text)
-            await update.message.reply_text(
+            await placeholder.edit_text(
                 "ملقتش نتائج. جرب البحث اليدوي.",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔎 YouTube Search", url=qurl)]])
             )
             return
-        for r in results[:5]:
-            pretty = norm_song_title(r['title']) or r['title']
-            caption = f"• {pretty}" + (f" — {r['channel']}" if r.get('channel') else "")
-            await update.message.reply_text(caption, reply_markup=listen_kb_youtube(r["url"], r["title"]))
+        body = "\n".join(fmt_youtube_line(r, i) for i, r in enumerate(results, 1))
+        await placeholder.edit_text(f"🎵 نتائج YouTube لـ: {text}\n\n{body}",
+                                    reply_markup=results_kb_youtube(results, text))
+        PREFETCH.schedule(results)
     else:
-        await update.message.reply_text(f"ببحث في Apple عن: {text}...")
-        tracks = comprehensive_apple_search(uid, text, limit_each=6)
+        placeholder = await msg.reply_text(f"ببحث في Apple عن: {text}...")
+        tracks = (await comprehensive_apple_search(uid, text, limit_each=6))[:6]
         if not tracks:
-            await update.message.reply_text("ملقتش نتائج. جرب اسم تاني أو أضف اسم الفنان.")
+            await placeholder.edit_text("ملقتش نتائج. جرب اسم تاني أو أضف اسم الفنان.")
+            return
+        body = "\n".join(fmt_track_line(t, i) for i, t in enumerate(tracks, 1))
+        await placeholder.edit_text(f"🍎 نتائج Apple لـ: {text}\n\n{body}", reply_markup=results_kb_apple(tracks))
+
+# --- Inline mode (@bot <query>) ---
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.6"))   # wait for the user to stop typing
+INLINE_MIN_CHARS = 2
+INLINE_PAGE_SIZE = 10
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+_inline_latest: Dict[int, str] = {}   # user_id -> id of their newest inline query
+
+def inline_youtube_result(r: Dict[str, str], bot_username: str):
+    vid = youtube_video_id(r["url"])
+    hit = AUDIO_CACHE.get(vid, YT_AUDIO_FORMAT) if vid and AUDIO_CACHE is not None else None
+    if hit and hit["file_id"] and not hit.get("parts"):   # already uploaded once: the audio itself, instantly
+        return InlineQueryResultCachedAudio(id=f"yt:{vid}", audio_file_id=hit["file_id"], caption=f"✅ {hit['title']}")
+    pretty = norm_song_title(r["title"]) or r["title"]
+    return InlineQueryResultArticle(
+        id=f"yt:{vid}",
+        title=pretty,
+        description=r.get("channel") or "YouTube",
+        thumbnail_url=f"https://i.ytimg.com/vi/{vid}/mqdefault.jpg",
+        input_message_content=InputTextMessageContent(f"🎵 {r['title']}\n{r['url']}"),
+        # Inline messages have no chat for the bot to reply in, so the download runs via a deep link.
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+            "▶️ Listen now", url=f"https://t.me/{bot_username}?start=yt_{vid}")]]),
+    )
+
+def inline_apple_result(t: Dict[str, Any]):
+    name = t.get("trackName") or "Track"
+    artist = t.get("artistName") or ""
+    if t.get("previewUrl"):
+        return InlineQueryResultAudio(id=f"ap:{t['trackId']}", audio_url=t["previewUrl"], title=name,
+                                      performer=artist, caption=fmt_track_line(t))
+    return InlineQueryResultArticle(id=f"ap:{t['trackId']}", title=name, description=artist,
+                                    input_message_content=InputTextMessageContent(fmt_track_line(t)))
+
+@instrumented("on_inline_query")
+async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    touch_user(update)
+    iq = update.inline_query
+    text = norm_text(iq.query or "")
+    if len(text) < INLINE_MIN_CHARS:
+        return
+    uid = iq.from_user.id
+    offset = int(iq.offset) if (iq.offset or "").isdigit() else 0
+    if not offset:   # a new keystroke: answer only if no newer query arrives during the debounce
+        _inline_latest[uid] = iq.id
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if _inline_latest.get(uid) != iq.id:
             return
-        for t in tracks[:6]:
-            await update.message.reply_text(fmt_track_line(t), reply_markup=kb_for_track(t))
+        del _inline_latest[uid]
 
+    if (get_pref(uid, "source") or "youtube") == "youtube":
+        try:
+            items = await yt_api_search(text, max_results=25)
+        except QueueFull:
+            await iq.answer([], cache_time=0, is_personal=True)   # busy: don't let Telegram cache "nothing"
+            return
+        make = lambda r: inline_youtube_result(r, context.bot.username)
+    else:
+        items = await comprehensive_apple_search(uid, text, limit_each=6)
+        make = inline_apple_result
+    page = items[offset:offset + INLINE_PAGE_SIZE]
+    more = offset + INLINE_PAGE_SIZE < len(items)
+    await iq.answer(
+        [make(it) for it in page],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,   # results follow the user's source/country prefs
+        next_offset=str(offset + INLINE_PAGE_SIZE) if more else "",
+    )
+
+# --- Callback buttons: "<kind>|<arg>" -> handler(query, arg) ---
+CALLBACK_EXPIRED_TEXT = "⌛ الزرار ده قديم. ابحث تاني من فضلك."
+
+async def cb_source(q, arg: str):
+    payload = cb_get(arg)
+    if payload is None and "|" in arg:   # buttons from before the registry: src|<source>|<quoted query>
+        src, quoted = arg.split("|", 1)
+        payload = {"src": src, "query": urllib.parse.unquote(quoted)}
+    if payload is None:
+        await q.message.reply_text(CALLBACK_EXPIRED_TEXT)
+        return
+    src, query = payload["src"], payload["query"]
+    set_pref(q.from_user.id, "source", "youtube" if src == "youtube" else "apple")
+    await q.edit_message_text(f"تمام. ببحث في {src.title()} عن: {query}")
+    await run_search(q.message, q.from_user.id, query)
+
+async def cb_play(q, arg: str):
+    payload = cb_get(arg)
+    t = payload["track"] if payload else None
+    if t is None and arg.isdigit():   # buttons from before the registry: play|<trackId>
+        t = await itunes_lookup(int(arg))
+    elif payload is None:
+        await q.message.reply_text(CALLBACK_EXPIRED_TEXT)
+        return
+    if not t or not t.get("previewUrl"):
+        await q.message.reply_text("المعاينة مش متاحة للمقطع ده.")
+        return
+    name = t.get("trackName") or "Track"
+    artist = t.get("artistName") or ""
+    cap = f"{name}" + (f" — {artist}" if artist else "")
+    await q.message.reply_audio(audio=t["previewUrl"], caption=cap, title=name, performer=artist)
+
+async def cb_youtube(q, arg: str):
+    await download_and_convert_yt(q.message, f"https://www.youtube.com/watch?v={arg}")
+
+async def cb_youtube_url(q, arg: str):   # buttons from before the registry: yt_dl|<quoted url>
+    await download_and_convert_yt(q.message, urllib.parse.unquote(arg))
+
+CALLBACK_HANDLERS = {"src": cb_source, "play": cb_play, "yt": cb_youtube, "yt_dl": cb_youtube_url}
+
+@instrumented("on_cb")
 async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     touch_user(update)
     q = update.callback_query
     await q.answer()
-    data = (q.data or "").split("|")
+    kind, _, arg = (q.data or "").partition("|")
+    handler = CALLBACK_HANDLERS.get(kind)
+    if handler is None:
+        return
+    if not q.message:
+        log.warning("Callback %s without a message to reply to", kind)
+        return
     try:
-        if data[0] == "src":
-            src = data[1]
-            query = urllib.parse.unquote(data[2])
-            await q.edit_message_text(f"تمام. ببحث في {src.title()} عن: {query}")
-            class _FakeMsg:
-                text = query
-                chat = q.message.chat
-                async def reply_text(self, *a, **k): return await q.message.reply_text(*a, **k)
-            fake_update = Update(update.update_id, message=_FakeMsg())
-            if src == "youtube":
-                set_pref(q.from_user.id, "source", "youtube")
-            else:
-                set_pref(q.from_user.id, "source", "apple")
-            await handle_query(fake_update, context)
-        elif data[0] == "play":
-            track_id = int(data[1])
-            t = itunes_lookup(track_id)
-            if not t or not t.get("previewUrl"):
-                await q.message.reply_text("المعاينة مش متاحة للمقطع ده.")
-                return
-            name = t.get("trackName", "Track")
-            artist = t.get("artistName", "")
-            cap = f"{name}" + (f" — {artist}" if artist else "")
-            await q.message.reply_audio(audio=t["previewUrl"], caption=cap, title=name, performer=artist)
-        elif data[0] == "yt_dl":
-            if not q.message or not q.message.chat:
-                await q.message.reply_text("❌ خطأ: لم يتم العثور على معلومات المحادثة.")
-                return
-            youtube_url = urllib.parse.unquote(data[1])
-            class _FakeUpdate:
-                def __init__(self, message, from_user):
-                    self.message = message
-                    self.effective_user = from_user
-            class _FakeMsg:
-                def __init__(self, chat):
-                    self.chat = chat
-                async def reply_text(self, text, *args, **kwargs):
-                    return await q.message.reply_text(text, *args, **kwargs)
-                async def reply_audio(self, audio, *args, **kwargs):
-                    return await q.message.reply_audio(audio, *args, **kwargs)
-            fake_msg = _FakeMsg(q.message.chat)
-            fake_update = _FakeUpdate(fake_msg, q.from_user)
-            await download_and_convert_yt(fake_update, context, youtube_url)
+        await handler(q, arg)
     except Exception as e:
         log.exception("callback error")
-        if q and q.message:
-            await q.message.reply_text(f"حصل خطأ: {e}")
+        await q.message.reply_text(f"حصل خطأ: {e}")
+
+# ========= Embedded HTTP server (webhook / health) =========
+BOT_MODE = os.getenv("BOT_MODE", "")               # "polling" | "webhook"; default: webhook when WEBHOOK_URL is set
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")   # public https base URL Telegram should call
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Always enforced. Without WEBHOOK_SECRET it is derived from the bot token, so every worker agrees on it.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or hmac.new(TOKEN.encode(), b"webhook-secret", "sha256").hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))   # Telegram side, 1..100
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "8080"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))   # updates processed in parallel
+HTTP_MAX_BODY = 1 << 20
+HTTP_MAX_HEADERS = 100
+HTTP_MAX_HEADER_BYTES = 16 << 10
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))   # headers + body of one request
+HTTP_IDLE_TIMEOUT = float(os.getenv("HTTP_IDLE_TIMEOUT", "75"))   # keep-alive connection with no request
+
+Route = Callable[[str, Dict[str, str], bytes], Awaitable[Tuple[int, str, bytes]]]
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                 405: "Method Not Allowed", 413: "Payload Too Large",
+                 431: "Request Header Fields Too Large", 503: "Service Unavailable"}
+
+class MiniHTTPServer:
+    """Just enough HTTP/1.1 (keep-alive, Content-Length bodies) to take Telegram webhooks and
+    answer probes on the event loop, without pulling in a web framework."""
+
+    def __init__(self, routes: Dict[str, Route]):
+        self.routes = routes
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port, limit=HTTP_MAX_HEADER_BYTES)
+        log.info("HTTP server listening on %s:%d", host, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                # Idle keep-alive connections get HTTP_IDLE_TIMEOUT; a started request must arrive in full
+                # within HTTP_READ_TIMEOUT, so slow or stalled clients can't pin connections.
+                line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    break
+                keep_alive = False
+                headers: Dict[str, str] = {}
+                header_bytes, header_lines = len(line), 0
+                while header_bytes <= HTTP_MAX_HEADER_BYTES and header_lines <= HTTP_MAX_HEADERS:
+                    h = await asyncio.wait_for(reader.readline(), HTTP_READ_TIMEOUT)
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    header_bytes, header_lines = header_bytes + len(h), header_lines + 1
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                raw_length = headers.get("content-length") or "0"
+                if header_bytes > HTTP_MAX_HEADER_BYTES or header_lines > HTTP_MAX_HEADERS:
+                    status, ctype, body = 431, "text/plain", b"headers too large"
+                elif not raw_length.isdigit():
+                    status, ctype, body = 400, "text/plain", b"bad content-length"
+                elif int(raw_length) > HTTP_MAX_BODY:
+                    status, ctype, body = 413, "text/plain", b"too large"
+                else:
+                    length = int(raw_length)
+                    payload = await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT) if length else b""
+                    route = self.routes.get(target.split("?", 1)[0])
+                    if route is None:
+                        status, ctype, body = 404, "text/plain", b"not found"
+                    else:
+                        try:
+                            status, ctype, body = await route(method, headers, payload)
+                        except Exception:
+                            log.exception("HTTP route %s failed", target)
+                            status, ctype, body = 503, "text/plain", b"error"
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, '')}\r\nContent-Type: {ctype}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    .encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, ConnectionError):
+            pass   # ValueError: a line longer than the StreamReader limit
+        finally:
+            writer.close()
+
+def webhook_routes(app) -> Dict[str, Route]:
+    async def webhook(method, headers, body):
+        if method != "POST":
+            return 405, "text/plain", b"POST only"
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(),
+                                   WEBHOOK_SECRET.encode()):
+            return 401, "text/plain", b"bad secret"
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except ValueError:
+            return 400, "text/plain", b"bad json"
+        await app.update_queue.put(update)   # processed by the Application, CONCURRENT_UPDATES at a time
+        return 200, "text/plain", b"ok"
+
+    async def healthz(method, headers, body):
+        return 200, "text/plain", b"ok"
+
+    async def readyz(method, headers, body):
+        ready = app.running and app.bot_data.get("webhook_set", False)
+        return (200, "text/plain", b"ready") if ready else (503, "text/plain", b"starting")
+
+    return {WEBHOOK_PATH: webhook, "/healthz": healthz, "/readyz": readyz}
+
+async def run_webhook(app):
+    """Webhook deployment: same lifecycle as run_polling(), but updates arrive over HTTP."""
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL missing in .env (needed for BOT_MODE=webhook)")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = MiniHTTPServer(webhook_routes(app))
+    await server.start(HTTP_HOST, HTTP_PORT)   # bind first so platform health checks pass early
+    await app.initialize()
+    await on_startup(app)
+    try:
+        await app.start()
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        app.bot_data["webhook_set"] = True
+        print("🔥 البوت شغال دلوقتي (webhook) ...")
+        await stop.wait()
+    finally:
+        app.bot_data["webhook_set"] = False
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+
+# ========= Performance surface (/metrics listener, /perf, sampling profiler) =========
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")   # keep it local; scrape through the host/sidecar
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))  # 0 = no /metrics listener
+LOOP_LAG_INTERVAL = 0.5
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))   # seconds between stack samples
+PROFILE_MAX_SECONDS = 300
+PERF_HANDLERS = ("handle_query", "on_cb", "download_and_convert_yt", "to_m4a_receive", "on_inline_query")
+
+_loop_lag = 0.0
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Sleeps `interval` in a loop; any oversleep is time the loop spent on someone else's work."""
+    global _loop_lag
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        _loop_lag = max(0.0, time.perf_counter() - t0 - interval)
+        METRICS.observe("bot_event_loop_lag_seconds", _loop_lag)
+
+def runtime_samples() -> Iterable[Sample]:
+    yield "bot_event_loop_lag_last_seconds", "gauge", {}, _loop_lag
+    for module, secs in IMPORT_TIMES.items():
+        yield "bot_import_seconds", "gauge", {"module": module}, secs
+    for milestone, secs in STARTUP_MARKS.items():
+        yield "bot_startup_seconds", "gauge", {"milestone": milestone}, secs
+    for pool in (MEDIA, SEARCH_POOL):
+        labels = {"pool": pool.name}
+        yield "bot_media_queue_depth", "gauge", labels, pool.depth()
+        yield "bot_media_queue_capacity", "gauge", labels, pool.max_queue
+        yield "bot_media_workers_busy", "gauge", labels, pool.busy
+        yield "bot_media_workers", "gauge", labels, pool.workers
+        yield "bot_media_rejected_total", "counter", labels, pool.rejected
+        yield "bot_media_pool_restarts_total", "counter", labels, pool.pool_restarts
+    for c in CACHES + [AI_HISTORY]:
+        yield "bot_cache_entries", "gauge", {"cache": c.name}, len(c)
+        yield "bot_cache_hits_total", "counter", {"cache": c.name}, c.hits
+        yield "bot_cache_misses_total", "counter", {"cache": c.name}, c.misses
+    if AUDIO_CACHE is not None:
+        for tier, n in (("file_id", AUDIO_CACHE.hits), ("disk", AUDIO_CACHE.file_hits)):
+            yield "bot_cache_hits_total", "counter", {"cache": f"audio_{tier}"}, n
+        yield "bot_cache_misses_total", "counter", {"cache": "audio"}, AUDIO_CACHE.misses
+    if isinstance(STATE, WriteBehindBackend):
+        yield "bot_state_pending_writes", "gauge", {}, STATE.pending()
+        yield "bot_state_commits_total", "counter", {}, STATE.commits
+        yield "bot_state_written_total", "counter", {}, STATE.written
+    yield "bot_singleflight_in_flight", "gauge", {}, len(FLIGHTS.waiters)
+    for kind, n in FLIGHTS.coalesced.items():
+        yield "bot_singleflight_coalesced_total", "counter", {"kind": kind}, n
+    yield "bot_telegram_calls_total", "counter", {}, TG_LIMITER.calls
+    yield "bot_telegram_throttled_total", "counter", {}, TG_LIMITER.throttled
+    yield "bot_telegram_retry_after_total", "counter", {}, TG_LIMITER.retry_afters
+    for k in YT_QUOTA.keys:
+        yield "bot_youtube_quota_remaining", "gauge", {"key": "…" + k[-4:]}, YT_QUOTA.remaining(k)
+    yield "bot_youtube_searches_total", "counter", {"via": "api"}, YT_QUOTA.api_searches
+    yield "bot_youtube_searches_total", "counter", {"via": "ytdlp"}, YT_QUOTA.fallback_searches
+    if PREFETCH.top_k:
+        yield "bot_prefetch_started_total", "counter", {}, PREFETCH.started
+        yield "bot_prefetch_used_total", "counter", {}, PREFETCH.hits_ready + PREFETCH.hits_waiting
+        yield "bot_prefetch_wasted_total", "counter", {}, PREFETCH.wasted
+
+METRICS.collectors.append(runtime_samples)
+
+class StackSampler:
+    """Poor man's sampling profiler: a thread snapshots the event-loop thread's Python stack every
+    `interval` seconds (sys._current_frames) and counts collapsed stacks. Output is the
+    flamegraph.pl / speedscope "collapsed" format; costs nothing while stopped."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, thread_id: int):
+        self.counts = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(thread_id,), name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self, thread_id: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{k} {v}\n" for k, v in sorted(self.counts.items(), key=lambda kv: -kv[1]))
+
+    def top_frames(self, n: int = 10) -> List[Tuple[str, int]]:
+        """Functions by self time (the leaf of each sample)."""
+        leaves: Dict[str, int] = {}
+        for k, v in self.counts.items():
+            leaf = k.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + v
+        return sorted(leaves.items(), key=lambda kv: -kv[1])[:n]
+
+PROFILER = StackSampler(PROFILE_INTERVAL)
+
+def _fmt_hist(label: str, h: Histogram) -> str:
+    return (f"• {label}: {h.count}× — p50 {h.quantile(0.5) * 1000:.0f} / p95 {h.quantile(0.95) * 1000:.0f} / "
+            f"p99 {h.quantile(0.99) * 1000:.0f} ms")
+
+def perf_summary() -> str:
+    lines = ["⏱ Handlers:"]
+    handlers = METRICS.histograms.get("bot_handler_seconds", {})
+    errors = METRICS.counters.get("bot_handler_errors_total", {})
+    for name in PERF_HANDLERS:
+        key = (("handler", name),)
+        if key in handlers:
+            lines.append(_fmt_hist(name, handlers[key]) + (f", {errors[key]:g} errors" if key in errors else ""))
+    for title, metric in (("🌐 Upstreams:", "bot_upstream_seconds"), ("📨 Telegram:", "bot_telegram_api_seconds"),
+                          ("🎛 Media stages:", "bot_media_stage_seconds")):
+        series = METRICS.histograms.get(metric, {})
+        if series:
+            lines.append(title)
+            top = sorted(series.items(), key=lambda kv: -kv[1].sum)[:8]   # where the time goes
+            lines += [_fmt_hist(",".join(v for _, v in labels), h) for labels, h in top]
+    lag = METRICS.histograms.get("bot_event_loop_lag_seconds", {}).get(())
+    if lag:
+        lines.append(f"🌀 Event loop lag: now {_loop_lag * 1000:.1f} ms, p50 {lag.quantile(0.5) * 1000:.1f} / "
+                     f"p99 {lag.quantile(0.99) * 1000:.1f} ms")
+    lines.append(f"🎛 Media pool: {MEDIA.busy}/{MEDIA.workers} busy, {MEDIA.depth()}/{MEDIA.max_queue} queued")
+    lines.append(f"🔬 Profiler: {'running' if PROFILER.running else 'off'}")
+    lines.append("🚀 " + startup_report())
+    return "\n".join(lines)
+
+async def _profile_for(msg: Message, seconds: float, stop: asyncio.Event):
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)   # /perf profile stop ends it early
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        await asyncio.to_thread(PROFILER.stop)
+    total = sum(PROFILER.counts.values())
+    if not total:
+        await msg.reply_text("🔬 مفيش عينات.")
+        return
+    top = "\n".join(f"{100 * n / total:5.1f}% {frame}" for frame, n in PROFILER.top_frames())
+    await msg.reply_text(f"🔬 {total} samples — top self time:\n{top}")
+    await msg.reply_document(InputFile(PROFILER.collapsed().encode(), filename="profile.collapsed.txt"),
+                             caption="flamegraph.pl / speedscope")
+
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/perf — latency summary; /perf profile [seconds] | /perf profile stop — sampling profiler."""
+    touch_user(update)
+    if ADMIN_ID and update.effective_user and update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("الأمر ده للمالك فقط.")
+        return
+    args = context.args or []
+    if args[:1] != ["profile"]:
+        await update.message.reply_text(perf_summary())
+        return
+    if args[1:2] == ["stop"]:
+        if PROFILER.running:
+            context.bot_data["profile_stop"].set()
         else:
-            log.error(f"Error processing callback query, could not reply: {e}")
+            await update.message.reply_text("🔬 الـ profiler مش شغال.")
+        return
+    if PROFILER.running:
+        await update.message.reply_text("🔬 الـ profiler شغال بالفعل.")
+        return
+    try:
+        seconds = min(float(args[1]) if len(args) > 1 else 30.0, PROFILE_MAX_SECONDS)
+    except ValueError:
+        await update.message.reply_text("استخدم: /perf profile [seconds]")
+        return
+    PROFILER.start(threading.get_ident())
+    await update.message.reply_text(f"🔬 بدأت أسجّل العينات لمدة {seconds:g} ثانية...")
+    stop = context.bot_data["profile_stop"] = asyncio.Event()
+    context.bot_data["profile_task"] = asyncio.create_task(_profile_for(update.message, seconds, stop))
+
+async def start_metrics_server() -> Optional[MiniHTTPServer]:
+    if not METRICS_PORT:
+        return None
+
+    async def metrics(method, headers, body):
+        return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render().encode()
+
+    server = MiniHTTPServer({"/metrics": metrics})
+    try:
+        await server.start(METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        log.warning("Metrics listener on %s:%d not started: %s", METRICS_HOST, METRICS_PORT, e)
+        return None
+    return server
+
+# ========= Lifecycle =========
+WARMUP_MODULES = os.getenv("WARMUP_MODULES", "1") == "1"   # import yt_dlp/pydub right after start, not on first use
+
+async def warm_up():
+    """Background work deferred from startup, run once the bot is already taking updates."""
+    t0 = time.perf_counter()
+    n = await USER_STORE.load_into(USERS) if USER_STORE is not None else 0
+    startup_mark("users loaded")
+    if WARMUP_MODULES:
+        await asyncio.to_thread(yt_dlp.load)
+        if TO_M4A_MODE == "pydub":
+            await asyncio.to_thread(pydub.load)
+        await MEDIA.submit(warmup_job, priority=PRIORITY_PREFETCH, label="warmup")
+    startup_mark("warm-up done")
+    log.info("Warm-up finished in %.2fs (%d users) — %s", time.perf_counter() - t0, n, startup_report())
+
+async def on_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Registered in a later group, so it runs after the update's real handler has finished.
+    if "first update handled" not in STARTUP_MARKS:
+        startup_mark("first update handled")
+        log.info(startup_report())
+
+
+async def on_startup(app):
+    MEDIA.start()
+    app.bot_data["warmup"] = asyncio.create_task(warm_up())
+    app.bot_data["users_flusher"] = asyncio.create_task(USER_STORE.run_flusher(USERS, USERS_FLUSH_INTERVAL))
+    app.bot_data["state_maintenance"] = asyncio.create_task(run_state_maintenance())
+    if isinstance(state(), WriteBehindBackend):
+        app.bot_data["state_writer"] = asyncio.create_task(state().run_flusher())
+    app.bot_data["loop_lag"] = asyncio.create_task(monitor_loop_lag())
+    app.bot_data["metrics_server"] = await start_metrics_server()
+    if PREFETCH.top_k:
+        app.bot_data["prefetch_sweeper"] = asyncio.create_task(PREFETCH.run_sweeper())
+    startup_mark("accepting updates")
+
+async def on_shutdown(app):
+    for name in ("warmup", "users_flusher", "state_maintenance", "state_writer", "prefetch_sweeper", "loop_lag", "profile_task"):
+        task = app.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    server = app.bot_data.pop("metrics_server", None)
+    if server:
+        await server.stop()
+    if PROFILER.running:
+        PROFILER.stop()
+    PREFETCH.stop()
+    await MEDIA.stop()
+    await SEARCH_POOL.stop()
+    save_users()
+    state().close()
+    await close_http()
 
 # ========= main =========
-if __name__ == "__main__":
-    load_users()
-    app = ApplicationBuilder().token(TOKEN).build()
+def build_app():
+    builder = (ApplicationBuilder().token(TOKEN).rate_limiter(TG_LIMITER).concurrent_updates(CONCURRENT_UPDATES)
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    if TG_API_URL:
+        builder = builder.base_url(f"{TG_API_URL}/bot").base_file_url(f"{TG_API_URL}/file/bot")
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("whoami", whoami))
     app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("perf", perf))
     app.add_handler(CommandHandler("to_m4a", to_m4a_start))
     app.add_handler(MessageHandler(filters.Document.ALL | filters.AUDIO | filters.VOICE | filters.VIDEO, to_m4a_receive))
     app.add_handler(MessageHandler(filters.Regex("^🎵 أغاني$|^🤖 AI Chat$|^🎯 Source: |^🌍 Country: "), on_buttons))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_query))
     app.add_handler(CallbackQueryHandler(on_cb))
-    print("🔥 البوت شغال دلوقتي ...")
-    app.run_polling()
+    app.add_handler(InlineQueryHandler(on_inline_query))
+    app.add_handler(TypeHandler(Update, on_first_update), group=1)
+    return app
+
+startup_mark("module loaded")
+
+if __name__ == "__main__":
+    load_users()
+    load_audio_cache()
+    app = build_app()
+    if (BOT_MODE or ("webhook" if WEBHOOK_URL else "polling")) == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        print("🔥 البوت شغال دلوقتي ...")
+        app.run_polling()
@@ -0,0 +1,9 @@
+"""main.py reads its settings at import time, so the environment is set up before any test imports it."""
+import os, sys, tempfile
+from pathlib import Path
+
+os.environ.setdefault("TOKEN", "123456:test")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("STATE_DB_PATH", os.path.join(tempfile.mkdtemp(), "state.db"))
+os.environ.setdefault("AUDIO_FILE_CACHE_DIR", "")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,125 @@
+import asyncio, socket
+
+import main
+
+
+async def echo(method, headers, body):
+    return 200, "text/plain", method.encode() + b" " + body
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def read_response(reader):
+    """(status, headers, body) of one response, or None if the server closed the connection."""
+    line = await asyncio.wait_for(reader.readline(), 5)
+    if not line:
+        return None
+    status = int(line.split()[1])
+    headers = {}
+    while (h := await reader.readline()) not in (b"\r\n", b""):
+        k, _, v = h.decode().partition(":")
+        headers[k.strip().lower()] = v.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers, body
+
+
+def exchange(*chunks: bytes, responses: int = 1, read_timeout: float = None):
+    """Sends the raw chunks to a fresh server; returns the parsed responses and whether it hung up after."""
+    async def run():
+        if read_timeout is not None:
+            main.HTTP_READ_TIMEOUT = read_timeout
+        server, port = main.MiniHTTPServer({"/echo": echo}), free_port()
+        await server.start("127.0.0.1", port)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            for chunk in chunks:
+                writer.write(chunk)
+            await writer.drain()
+            out = [await read_response(reader) for _ in range(responses)]
+            closed = await asyncio.wait_for(reader.read(1), 5) == b""
+            writer.close()
+            return out, closed
+        finally:
+            await server.stop()
+    saved = main.HTTP_READ_TIMEOUT
+    try:
+        return asyncio.run(run())
+    finally:
+        main.HTTP_READ_TIMEOUT = saved
+
+
+def test_post_body_is_routed():
+    [(status, headers, body)], closed = exchange(
+        b"POST /echo HTTP/1.1\r\nContent-Length: 5\r\nConnection: close\r\n\r\nhello")
+    assert (status, body) == (200, b"POST hello")
+    assert headers["connection"] == "close" and closed
+
+
+def test_keep_alive_serves_several_requests():
+    req = b"GET /echo HTTP/1.1\r\nHost: x\r\n\r\n"
+    out, _ = exchange(req, req, b"GET /echo HTTP/1.1\r\nConnection: close\r\n\r\n", responses=3)
+    assert [r[0] for r in out] == [200, 200, 200]
+    assert [r[1]["connection"] for r in out] == ["keep-alive", "keep-alive", "close"]
+
+
+def test_http10_closes_after_response():
+    [(status, headers, _)], closed = exchange(b"GET /echo HTTP/1.0\r\n\r\n")
+    assert status == 200 and headers["connection"] == "close" and closed
+
+
+def test_unknown_route_is_404():
+    [(status, _, _)], _ = exchange(b"GET /nope HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert status == 404
+
+
+def test_malformed_content_length_is_400():
+    for value in (b"abc", b"-1", b"1.5", b"0x10"):
+        [(status, _, _)], closed = exchange(b"POST /echo HTTP/1.1\r\nContent-Length: " + value + b"\r\n\r\n")
+        assert status == 400 and closed, value
+
+
+def test_oversized_content_length_is_413_without_reading_the_body():
+    size = str(main.HTTP_MAX_BODY + 1).encode()
+    [(status, _, _)], closed = exchange(b"POST /echo HTTP/1.1\r\nContent-Length: " + size + b"\r\n\r\n")
+    assert status == 413 and closed
+
+
+def test_body_at_the_limit_is_accepted():
+    body = b"x" * main.HTTP_MAX_BODY
+    [(status, _, echoed)], _ = exchange(
+        b"POST /echo HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n" % len(body), body)
+    assert status == 200 and echoed == b"POST " + body
+
+
+def test_too_many_header_lines_is_431():
+    many = b"".join(b"x-h: v\r\n" for _ in range(main.HTTP_MAX_HEADERS + 1))   # repeats count, not unique names
+    [(status, _, _)], closed = exchange(b"GET /echo HTTP/1.1\r\n" + many + b"\r\n")
+    assert status == 431 and closed
+
+
+def test_header_block_over_byte_cap_is_431():
+    line = b"x-pad: " + b"a" * 1000 + b"\r\n"
+    n = main.HTTP_MAX_HEADER_BYTES // len(line) + 1
+    assert n <= main.HTTP_MAX_HEADERS
+    [(status, _, _)], closed = exchange(b"GET /echo HTTP/1.1\r\n" + line * n + b"\r\n")
+    assert status == 431 and closed
+
+
+def test_single_header_line_over_stream_limit_drops_connection():
+    huge = b"x-big: " + b"a" * (main.HTTP_MAX_HEADER_BYTES + 10) + b"\r\n"
+    [resp], closed = exchange(b"GET /echo HTTP/1.1\r\n" + huge + b"\r\n")
+    assert resp is None and closed
+
+
+def test_truncated_body_times_out():
+    [resp], closed = exchange(b"POST /echo HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc", read_timeout=0.2)
+    assert resp is None and closed
+
+
+def test_garbage_request_line_drops_connection():
+    [resp], closed = exchange(b"HELLO\r\n\r\n")
+    assert resp is None and closed
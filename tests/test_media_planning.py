@@ -0,0 +1,82 @@
+import math
+
+import pytest
+
+import main
+from main import pick_bitrate, plan_parts
+
+
+def seconds_at(kbps: int, max_bytes: int) -> float:
+    """Longest duration that still fits max_bytes at kbps, per pick_bitrate's budget formula."""
+    return max_bytes * 8 * main.SIZE_HEADROOM / (kbps * 1000)
+
+
+def test_unknown_duration_gets_the_best_bitrate():
+    assert pick_bitrate(0, main.TG_UPLOAD_LIMIT) == main.AUDIO_BITRATES[0]
+
+
+@pytest.mark.parametrize("kbps", main.AUDIO_BITRATES)
+def test_bitrate_steps_down_exactly_at_the_budget(kbps):
+    limit = 50 * 1024 * 1024
+    fits = seconds_at(kbps, limit)
+    assert pick_bitrate(fits * 0.999, limit) == kbps
+    lower = [b for b in main.AUDIO_BITRATES if b < kbps]
+    assert pick_bitrate(fits * 1.001, limit) == (lower[0] if lower else None)
+
+
+def test_nothing_fits_returns_none():
+    assert pick_bitrate(10 * 3600, 50 * 1024 * 1024) is None
+
+
+def check_cover(parts, duration, max_seconds):
+    assert parts[0][0] == 0 and parts[-1][1] == duration
+    for (_, end, _), (start, _, _) in zip(parts, parts[1:]):
+        assert end == start
+    assert all(end - start <= max_seconds + 1e-9 for start, end, _ in parts)
+
+
+def test_short_audio_is_one_part():
+    assert plan_parts(100, None, 100) == [(0.0, 100, "")]
+
+
+def test_even_split_without_chapters():
+    parts = plan_parts(100, None, 40)
+    check_cover(parts, 100, 40)
+    assert len(parts) == math.ceil(100 / 40)
+    assert all(math.isclose(end - start, 100 / 3) for start, end, _ in parts)
+
+
+def test_cuts_on_the_last_chapter_that_fits():
+    chapters = [{"start_time": 0, "title": "Intro"}, {"start_time": 30, "title": "A"},
+                {"start_time": 55, "title": "B"}, {"start_time": 80, "title": "C"}]
+    parts = plan_parts(100, chapters, 60)
+    assert parts == [(0.0, 55.0, "Intro"), (55.0, 100, "B")]
+
+
+def test_chapter_on_the_exact_limit_is_used():
+    chapters = [{"start_time": 0, "title": "A"}, {"start_time": 60, "title": "B"}]
+    assert plan_parts(100, chapters, 60) == [(0.0, 60.0, "A"), (60.0, 100, "B")]
+
+
+def test_sliver_chapter_falls_back_to_an_even_split():
+    chapters = [{"start_time": 0, "title": "A"}, {"start_time": 5, "title": "B"}]
+    parts = plan_parts(100, chapters, 60)
+    check_cover(parts, 100, 60)
+    assert [(s, e) for s, e, _ in parts] == [(0.0, 50.0), (50.0, 100)]
+    assert [t for _, _, t in parts] == ["A", "B"]   # each part is named after the chapter it starts in
+
+
+def test_chapters_outside_the_audio_are_ignored():
+    chapters = [{"start_time": -5, "title": "x"}, {"start_time": 500, "title": "y"}, {"start_time": None}]
+    parts = plan_parts(90, chapters, 40)
+    check_cover(parts, 90, 40)
+    assert len(parts) == 3
+
+
+@pytest.mark.parametrize("duration,max_seconds", [(7200, 1800), (3601, 1200), (100.5, 10), (61, 60)])
+def test_parts_always_cover_the_audio_within_the_limit(duration, max_seconds):
+    chapters = [{"start_time": t, "title": str(t)} for t in range(0, int(duration), 457)]
+    for chs in (None, chapters):
+        parts = plan_parts(duration, chs, max_seconds)
+        check_cover(parts, duration, max_seconds)
+        assert len(parts) >= math.ceil(duration / max_seconds)
@@ -0,0 +1,33 @@
+import asyncio, time
+
+from main import TokenBucket
+
+
+def test_burst_then_paced():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=3)
+        burst = [await bucket.acquire() for _ in range(3)]
+        t0 = time.monotonic()
+        paced = await bucket.acquire()
+        return burst, paced, time.monotonic() - t0
+    burst, paced, elapsed = asyncio.run(run())
+    assert burst == [0.0, 0.0, 0.0]
+    assert paced > 0 and elapsed >= 0.015   # one token takes 1/50 s to refill
+
+
+def test_refill_is_capped():
+    bucket = TokenBucket(rate=1000, capacity=2)
+    bucket.tokens, bucket.stamp = 0, time.monotonic() - 60
+    assert bucket.full()
+    assert bucket.tokens == 2
+
+
+def test_retry_after_blocks_even_with_tokens():
+    async def run():
+        bucket = TokenBucket(rate=1000, capacity=5)
+        bucket.blocked_until = time.monotonic() + 0.1
+        assert not bucket.full()
+        t0 = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - t0
+    assert asyncio.run(run()) >= 0.09
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import main
+from main import MemoryBackend, SQLiteBackend, TTLCache, WriteBehindBackend
+
+
+@pytest.fixture
+def shared_state(tmp_path, monkeypatch):
+    backend = WriteBehindBackend(SQLiteBackend(tmp_path / "state.db"))
+    monkeypatch.setattr(main, "STATE", backend)
+    yield backend
+    backend.close()
+
+
+def test_ttlcache_expires_entries():
+    cache = TTLCache("t", 10, ttl=0.05)
+    cache.set("k", "v")
+    assert cache.get("k") == "v"
+    time.sleep(0.06)
+    assert cache.get("k", "gone") == "gone"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttlcache_per_entry_ttl_and_lru_bound():
+    cache = TTLCache("t", 2, ttl=60)
+    cache.set("a", 1, ttl=0.01)
+    cache.set("b", 2)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    cache.set("c", 3)
+    cache.get("b")        # b is now the most recently used
+    cache.set("d", 4)     # evicts c
+    assert len(cache) == 2 and cache.get("c") is None and cache.get("b") == 2
+
+
+def test_shared_read_through_keeps_backend_deadline(shared_state):
+    cache = TTLCache("t", 10, ttl=3600, shared=True)
+    cache.set("k", "v", ttl=30)
+    for flushed in (False, True):   # from the write-behind buffer, then from SQLite
+        if flushed:
+            shared_state.flush()
+        cache._data.clear()
+        assert cache.get("k") == "v"
+        assert 28 < cache._data["k"][0] - time.time() <= 30
+
+
+def test_shared_entry_expired_in_backend_is_a_miss(shared_state):
+    cache = TTLCache("t", 10, ttl=3600, shared=True)
+    cache.set("k", "v", ttl=0.05)
+    shared_state.flush()
+    cache._data.clear()
+    time.sleep(0.06)
+    assert cache.get("k") is None
+
+
+def test_write_behind_reads_its_own_writes_and_deletes(shared_state):
+    shared_state.set("ns", "a", {"file_id": "x"})
+    shared_state.set("ns", "b", {"file_id": ""})
+    shared_state.delete("ns", "a")
+    assert shared_state.get("ns", "a") is None and shared_state.pending() == 2
+    assert shared_state.count("ns") == 1 and shared_state.pending() == 0
+    assert shared_state.count_with("ns", "file_id") == 0
+
+
+@pytest.mark.parametrize("make", [MemoryBackend, lambda: None])
+def test_count_with_skips_blank_fields(make, tmp_path):
+    backend = make() or SQLiteBackend(tmp_path / "s.db")
+    backend.set_many("audio", {"a": {"file_id": "x"}, "b": {"file_id": ""}, "c": {"title": "t"}})
+    assert backend.count("audio") == 3
+    assert backend.count_with("audio", "file_id") == 1